@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import time
+
+import requests
+
+from metrics import Metrics, get_body_size, get_endpoint
+from utils import (READ_TIMEOUT, THROTTLE_STATUS_CODES, TokenManager, get_backoff, get_base_url, get_headers,
+                   get_retry_after, get_retry_status_codes)
+
+logger = logging.getLogger('sigma.client')
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse():
+    """ Buffered API response exposing the parts of requests.Response the scripts use
+
+        raise_for_status() raises requests.exceptions.HTTPError so error handling written
+        for SigmaClient works unchanged with AsyncSigmaClient.
+    """
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        pass
+
+
+class AsyncStreamResponse():
+    """ Successful API response whose body has not been read yet
+
+        Returned for 200/206 responses when a request is made with stream=True. The body must be
+        consumed with iter_content() and the response closed afterwards.
+    """
+
+    def __init__(self, raw, url):
+        self.status_code = raw.status
+        self.headers = raw.headers
+        self.url = url
+        self._raw = raw
+
+    async def iter_content(self, chunk_size):
+        try:
+            async for chunk in self._raw.content.iter_chunked(chunk_size):
+                yield chunk
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # Raised as the error an interrupted requests download raises, so the download is resumed
+            raise requests.exceptions.ChunkedEncodingError(str(e) or type(e).__name__) from e
+
+    def close(self):
+        self._raw.release()
+
+
+class AsyncSigmaClient():
+    """ asyncio counterpart of utils.SigmaClient
+
+        Use as an async context manager so the underlying aiohttp session is opened and
+        closed on the running event loop:
+
+            async with AsyncSigmaClient(env, cloud, client_id, client_secret) as client:
+                response = await client.get('v2/members')
+
+        The access token is fetched on the first request and refreshed before it expires. Token
+        refreshes are single-flight: any number of concurrent requests receiving a 401 trigger one
+        /v2/auth/token call. Pass the token_manager of a SigmaClient to share its token, and its
+        metrics to record both clients' requests together. A request fails once no data has
+        arrived for read_timeout seconds; a download stalled this way is resumed.
+    """
+
+    def __init__(self, env, cloud, client_id, client_secret, pool_maxsize=100, keep_alive=True,
+                 rate_limiter=None, token_cache=False, token_manager=None, metrics=None, read_timeout=READ_TIMEOUT):
+        if aiohttp is None:
+            raise ImportError("AsyncSigmaClient requires aiohttp: pipenv install aiohttp")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = get_base_url(cloud, env)
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.read_timeout = read_timeout
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics if metrics is not None else Metrics()
+        if token_manager is None:
+            token_manager = TokenManager(self.base_url, client_id, client_secret, background=False, cache=token_cache,
+                                         metrics=self.metrics)
+        self.tokens = token_manager
+        self.session = None
+        self._token_lock = None
+        self._throttle_stats = {"useful_seconds": 0.0, "backoff_seconds": 0.0, "retries": 0, "throttled_responses": 0}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, force_close=not self.keep_alive)
+            # aiohttp's default 300s total timeout would fail any download taking longer
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._token_lock = asyncio.Lock()
+
+    def throttle_stats(self):
+        """ Returns how much time requests spent throttled compared to talking to the API
+            :returns:       Same fields as SigmaClient.throttle_stats()
+        """
+        stats = dict(self._throttle_stats)
+        stats["limiter_seconds"] = self.rate_limiter.throttled_time if self.rate_limiter else 0.0
+        stats["throttled_seconds"] = stats["limiter_seconds"] + stats["backoff_seconds"]
+        if self.rate_limiter:
+            stats["current_rate"] = self.rate_limiter.rate
+        return stats
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _fetch_token(self):
+        payload = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret
+        }
+        started = time.perf_counter()
+        async with self.session.post(f"{self.base_url}/v2/auth/token", data=payload) as response:
+            content = await response.read()
+        self.metrics.observe('POST', 'v2/auth/token', response.status, time.perf_counter() - started,
+                             bytes_received=len(content))
+        data = json.loads(content)
+        return self.tokens.store(data)
+
+    async def _token(self, stale=None):
+        """ Returns a valid access token, fetching one if needed
+            :stale:         Access token that received a 401 and must be replaced
+        """
+        token = self.tokens.current()
+        if token is not None and token != stale:
+            return token
+        async with self._token_lock:
+            # Another coroutine may have refreshed the token while this one waited for the lock
+            token = self.tokens.current()
+            if token is None or token == stale:
+                token = await self._fetch_token()
+        return token
+
+    async def post(self, path, **kwargs):
+        return await self._exec('POST', path, **kwargs)
+
+    async def get(self, path, **kwargs):
+        return await self._exec('GET', path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self._exec('PUT', path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self._exec('DELETE', path, **kwargs)
+
+    async def patch(self, path, **kwargs):
+        return await self._exec('PATCH', path, **kwargs)
+
+    async def _exec(self, method, path, retries=5, stream=False, retry_status_codes=None, **kwargs):
+        await self.open()
+        url = f'{self.base_url}/{path}'
+        endpoint = get_endpoint(path)
+        retry_status_codes = get_retry_status_codes(method, retry_status_codes)
+        # aiohttp serializes json= bodies with json.dumps, so this matches what is sent
+        bytes_sent = get_body_size(json.dumps(kwargs['json']) if 'json' in kwargs else kwargs.get('data'))
+        headers: dict = kwargs.pop('headers', {})
+        refreshed = False
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.metrics.rate_limited(await self.rate_limiter.acquire_async())
+            token = await self._token()
+            headers.update(get_headers(token))
+            started = time.perf_counter()
+            try:
+                raw = await self.session.request(method, url, headers=headers, **kwargs)
+                if stream and raw.status in (200, 206):
+                    response = AsyncStreamResponse(raw, url)
+                else:
+                    async with raw:
+                        response = AsyncResponse(raw.status, raw.headers, await raw.read(), url)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                elapsed = time.perf_counter() - started
+                self._throttle_stats["useful_seconds"] += elapsed
+                self.metrics.observe(method, endpoint, None, elapsed)
+                if attempt >= retries:
+                    logger.warning("Request failed", extra={'fields': {
+                        'method': method, 'endpoint': endpoint, 'attempt': attempt, 'error': str(e)}})
+                    raise requests.exceptions.ConnectionError(str(e)) from e
+                reason = 'connection_error'
+                delay = get_backoff(attempt)
+            else:
+                elapsed = time.perf_counter() - started
+                self._throttle_stats["useful_seconds"] += elapsed
+                if isinstance(response, AsyncStreamResponse):
+                    bytes_received = int(response.headers.get('Content-Length') or 0)
+                else:
+                    bytes_received = len(response.content)
+                self.metrics.observe(method, endpoint, response.status_code, elapsed, bytes_sent, bytes_received)
+                logger.debug("Request completed", extra={'fields': {
+                    'method': method, 'endpoint': endpoint, 'status': response.status_code,
+                    'seconds': round(elapsed, 4), 'bytes_sent': bytes_sent, 'bytes_received': bytes_received}})
+                if response.status_code == 401 and not refreshed:
+                    refreshed = True
+                    await self._token(stale=token)
+                    continue
+                if response.status_code in THROTTLE_STATUS_CODES:
+                    self._throttle_stats["throttled_responses"] += 1
+                    if self.rate_limiter:
+                        self.rate_limiter.on_throttle()
+                elif self.rate_limiter:
+                    self.rate_limiter.on_success()
+                if response.status_code not in retry_status_codes or attempt >= retries:
+                    return response
+                delay = get_retry_after(response)
+                if delay is None:
+                    delay = get_backoff(attempt)
+                reason = response.status_code
+            self.metrics.retry(method, endpoint, reason, delay)
+            logger.info("Retrying request", extra={'fields': {
+                'method': method, 'endpoint': endpoint, 'attempt': attempt + 1, 'reason': reason, 'delay': delay}})
+            attempt += 1
+            self._throttle_stats["retries"] += 1
+            self._throttle_stats["backoff_seconds"] += delay
+            await asyncio.sleep(delay)
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
-import argparse
 import csv
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from urllib.parse import quote
 
 import requests
 
-from utils import SigmaClient
+from journal import FAILED, SUCCEEDED, UNCHANGED, Journal
+from member_cache import MemberCache, get_member_cache_path
+from utils import RateLimiter, percentile, run_command
 
 def update_member(client, user_id, payload):
     """ Update member
@@ -40,183 +48,871 @@ def update_member(client, user_id, payload):
         return data
 
 
-def get_all_members(client):
-    data = []
-    moreResults = True
-    nextPage = ''
-    while moreResults:
-        try:
-            response = client.get(
-                f'v2/members?includeArchived=true&limit=500{nextPage}'
-            )
-            response.raise_for_status()
-
-        except requests.exceptions.HTTPError as errh:
-            raise Exception(f"Connection Error: {errh}, API response: {errh.response.text}")
-        except requests.exceptions.ConnectionError as errc:
-            raise Exception(f"Connection Error: {errc}, API response: {errc.response.text}")
-        except requests.exceptions.Timeout as errt:
-            raise Exception(f"Timeout Error: {errt}, API response: {errt.response.text}")
-        except requests.exceptions.RequestException as err:
-            raise Exception(f"Other Error: {err}, API response: {err.response.text}")
-        else:
-            resp = response.json()
-            data = data + resp['entries']
+def get_members_page(client, page=None):
+    """ Gets one page of organization members
+
+        :client:        SigmaClient
+        :page:          Page token returned as nextPage by the previous page, None for the first page
+
+        :returns:       Response JSON with the page's entries and the nextPage token
+
+    """
+    nextPage = f'&page={page}' if page is not None else ''
+    try:
+        response = client.get(
+            f'v2/members?includeArchived=true&limit=500{nextPage}'
+        )
+        response.raise_for_status()
+
+    except requests.exceptions.HTTPError as errh:
+        raise Exception(f"Connection Error: {errh}, API response: {errh.response.text}")
+    except requests.exceptions.ConnectionError as errc:
+        raise Exception(f"Connection Error: {errc}, API response: {errc.response.text}")
+    except requests.exceptions.Timeout as errt:
+        raise Exception(f"Timeout Error: {errt}, API response: {errt.response.text}")
+    except requests.exceptions.RequestException as err:
+        raise Exception(f"Other Error: {err}, API response: {err.response.text}")
+    else:
+        return response.json()
+
+
+def iter_members(client, prefetch=True):
+    """ Lazily yields every organization member, page by page
+
+        :client:        SigmaClient
+        :prefetch:      Request the next page in the background while the current one is consumed
+
+        :returns:       Generator of member records
+
+    """
+    if not prefetch:
+        page = None
+        while True:
+            resp = get_members_page(client, page)
+            yield from resp['entries']
+            page = resp['nextPage']
+            if page is None:
+                return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(get_members_page, client, None)
+        while future is not None:
+            resp = future.result()
             if resp['nextPage'] is None:
-                moreResults = False
+                future = None
             else:
-                pageID = str(resp['nextPage'])
-                nextPage = f'&page={pageID}'
-    return data
+                future = executor.submit(get_members_page, client, str(resp['nextPage']))
+            yield from resp['entries']
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Batch update organization members\' user attributes using members\' email addresses as identifiers')
+def get_all_members(client):
+    return list(iter_members(client))
+
+
+def find_member(client, email):
+    """ Looks up a single member by email
+
+        :client:        SigmaClient
+        :email:         Email of the member
+
+        :returns:       Member record with exactly this email, or None
+
+    """
+    try:
+        response = client.get(f'v2/members?includeArchived=true&limit=50&search={quote(email)}')
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as errh:
+        raise Exception(errh.response.status_code, f"Member lookup failed: {errh.response.text}")
+    except requests.exceptions.RequestException as err:
+        raise Exception(f"Member lookup failed: {err}")
+    for member in response.json()['entries']:
+        if member['email'] == email:
+            return member
+    return None
+
+
+def remember_update(members_dict, member_email, update_member_response):
+    """ Records a member's new attributes after a successful update
+
+        Keeps members_dict, which may be a MemberCache, in step with the API, including when the
+        update changed the member's email.
+
+    """
+    member = members_dict.pop(member_email, None) or {}
+    member.update(update_member_response)
+    members_dict[member.get('email', member_email)] = member
+
+
+async def async_update_member(client, user_id, payload):
+    """ Update member using an AsyncSigmaClient
+
+        :client:        AsyncSigmaClient
+        :userId:        ID of the user to update
+        :payload:       Fields to update
+
+        :returns:       Response JSON
+
+    """
+    try:
+        response = await client.patch(
+            f"v2/members/{user_id}",
+            json=payload
+        )
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as errh:
+        raise Exception(errh.response.status_code, f"API message: {errh.response.json()['message']}")
+    except requests.exceptions.RequestException as err:
+        raise Exception(f"Other Error: {err}")
+    else:
+        return response.json()
+
+
+def parse_text(value):
+    """ Values of a single character or less are treated as blank and not sent """
+    if value and len(value) > 1:
+        return value
+    return None
+
+
+def parse_bool(value):
+    if value == "True":
+        return True
+    if value == "False":
+        return False
+    return None
+
+
+# Optional CSV columns and the request payload fields they are sent as
+# Blank values, and columns absent from the CSV, are left out of the payload
+OPTIONAL_COLUMNS = {
+    'First Name': ('firstName', parse_text),
+    'Last Name': ('lastName', parse_text),
+    'New Email': ('email', parse_text),
+    'Member Type': ('memberType', parse_text),
+    'isArchived': ('isArchived', parse_bool),
+}
+
+
+def compile_columns(header):
+    """ Maps the CSV header to the payload fields to build for every row
+
+        :header:        List of CSV column names
+
+        :returns:       Tuple of (index of the Email column, list of (column index, payload field, parser))
+
+    """
+    if 'Email' not in header:
+        raise ValueError("A column titled \"Email\" is a required column in the CSV for this script to be able to run")
+    columns = []
+    for index, name in enumerate(header):
+        if name in OPTIONAL_COLUMNS:
+            field, parse = OPTIONAL_COLUMNS[name]
+            columns.append((index, field, parse))
+    return header.index('Email'), columns
+
+
+def read_member_updates(path):
+    """ Streams the updates described by a CSV file
+
+        The header is validated as soon as this is called; rows are then parsed lazily, one at a
+        time, as the returned generator is consumed.
+
+        :path:          Path to the CSV file
+
+        :returns:       Generator of (member email, request payload) tuples
+
+    """
+    csvfile = open(path, newline='')
+    reader = csv.reader(csvfile)
+    try:
+        email_index, columns = compile_columns(next(reader, []))
+    except ValueError:
+        csvfile.close()
+        raise
+    return stream_member_updates(csvfile, reader, email_index, columns)
+
+
+def stream_member_updates(csvfile, reader, email_index, columns):
+    with csvfile:
+        for row in reader:
+            width = len(row)
+            member_email = parse_text(row[email_index]) if email_index < width else None
+            payload = {}
+            for index, field, parse in columns:
+                if index < width:
+                    value = parse(row[index])
+                    if value is not None:
+                        payload[field] = value
+            yield member_email, payload
+
+
+def describe_unknown_member(member_email):
+    return [
+        f"\u2717 UPDATE FAILURE!",
+        f"Member email: {member_email}",
+        f"This email address is either invalid, or is not found, or is for a deactivated account (reactivate the account first to change its user attributes)",
+        f"###",
+    ]
+
+
+def describe_failure(member_email, e):
+    lines = [
+        f"\u2717 UPDATE FAILURE!",
+        f"Member email: {member_email}",
+        f"The below API error prevented an update being applied for this member:",
+        f"{e}",
+    ]
+    if e.args[0] == 404:
+        lines.append(f"If the 404 error message is \"Member type name is not found\", the Member Type specified is invalid/not in use")
+    if e.args[0] == 409:
+        lines.append(f"If the 409 error message is \"Duplicate record\", the New Email specified is in use by an existing member")
+    lines.append(f"###")
+    return lines
+
+
+def describe_success(member_email, payload, update_member_response):
+    if not payload:
+        return [
+            f"\u2013 UPDATED NOTHING!",
+            f"Member email: {member_email}",
+            f"There were no user attribute values included in the CSV for this member",
+            f"###",
+        ]
+    lines = [f"\u2713 UPDATE SUCCESS!", f"Member email: {member_email}"]
+    if 'firstName' in payload:
+        lines.append(f"First Name updated to: {update_member_response['firstName']}")
+    if 'lastName' in payload:
+        lines.append(f"Last Name updated to: {update_member_response['lastName']}")
+    if 'email' in payload:
+        lines.append(f"Email updated to: {update_member_response['email']}")
+    if 'memberType' in payload:
+        lines.append(f"Member type updated to: {update_member_response['memberType']}")
+    if 'isArchived' in payload:
+        lines.append(f"isArchived updated to: {update_member_response['isArchived']}")
+    lines.append(f"###")
+    return lines
+
+
+# Payload fields whose values the API does not treat as case sensitive
+CASE_INSENSITIVE_FIELDS = ('memberType',)
+
+
+def diff_payload(payload, member):
+    """ Drops the fields of an update payload that already match the member's current values
+
+        :payload:       Request payload built from the CSV
+        :member:        Member record as returned by the members API
+
+        :returns:       Payload containing only the fields that would change
+
+    """
+    changes = {}
+    for field, value in payload.items():
+        current = member.get(field)
+        if field in CASE_INSENSITIVE_FIELDS and isinstance(value, str) and isinstance(current, str):
+            if value.lower() == current.lower():
+                continue
+        elif value == current:
+            continue
+        changes[field] = value
+    return changes
+
+
+def describe_unchanged(member_email, payload):
+    if not payload:
+        return [
+            f"\u2013 UPDATED NOTHING!",
+            f"Member email: {member_email}",
+            f"There were no user attribute values included in the CSV for this member",
+            f"###",
+        ]
+    return [
+        f"\u2013 ALREADY UP TO DATE!",
+        f"Member email: {member_email}",
+        f"The user attribute values in the CSV already match this member, no update was sent",
+        f"###",
+    ]
+
+
+def plan_member_update(update, members_dict, skip_unchanged=False):
+    """ Decides what request, if any, a CSV row needs
+
+        :update:            Tuple of (member email, request payload) read from the CSV
+        :members_dict:      Dict (or MemberCache) of member emails to member records
+        :skip_unchanged:    Only send fields that differ from the member's current values
+
+        :returns:           Tuple of (result, memberId, payload to send). result is the finished result
+                            tuple for rows that need no request or whose member could not be looked
+                            up, otherwise None
+
+    """
+    member_email, payload = update
+    try:
+        member = members_dict.get(member_email)
+    except Exception as e:
+        # A MemberCache lookup failed; only this row fails
+        return (describe_failure(member_email, e), True, None, False), None, None
+    if member is None:
+        return (describe_unknown_member(member_email), True, None, False), None, None
+    if skip_unchanged:
+        payload = diff_payload(payload, member)
+        if not payload:
+            return (describe_unchanged(member_email, update[1]), False, None, True), None, None
+    return None, member['memberId'], payload
+
+
+# Planned actions for a row, in the order the plan summary lists them. Rows planned as update are
+# sent; no_changes and unchanged rows need no request; the rest are rejected without one.
+PLAN_ACTIONS = ('update', 'unchanged', 'no_changes', 'missing_email', 'duplicate_email', 'unknown_email',
+                'invalid_member_type', 'email_in_use')
+PLAN_NO_OPS = ('unchanged', 'no_changes')
+PLAN_REPORT_COLUMNS = ('Row', 'Email', 'Action', 'Detail')
+
+
+def get_member_types(members_dict):
+    """ Member types in use in the organization, lower-cased, as the types an update may set """
+    return {member['memberType'].lower() for member in members_dict.values() if member.get('memberType')}
+
+
+def check_member_update(row_number, update, members_dict, seen_emails, new_emails, member_types):
+    """ Decides what a CSV row needs, without sending anything
+
+        :row_number:    Position of the row in the CSV, from 1
+        :update:        Tuple of (member email, request payload) read from the CSV
+        :members_dict:  Dict (or MemberCache) of member emails to member records; a MemberCache
+                        is only read through peek, so planning never calls the API
+        :seen_emails:   Dict of lower-cased emails to the row they first appeared on, updated in place
+        :new_emails:    Dict of lower-cased New Email values to the row claiming them, updated in place
+        :member_types:  Set of lower-cased valid member types
+
+        :returns:       Tuple of (action, detail), action being one of PLAN_ACTIONS
+
+    """
+    member_email, payload = update
+    if not member_email:
+        return 'missing_email', "The Email column is blank"
+    first_row = seen_emails.get(member_email.lower())
+    if first_row is not None:
+        return 'duplicate_email', f"The email also appears on row {first_row}"
+    seen_emails[member_email.lower()] = row_number
+    peek = getattr(members_dict, 'peek', members_dict.get)
+    member = peek(member_email)
+    if member is None:
+        return 'unknown_email', "No active member has this email"
+    member_type = payload.get('memberType')
+    if member_type and member_type.lower() not in member_types:
+        return 'invalid_member_type', f"Member type {member_type} is not one of: {', '.join(sorted(member_types))}"
+    new_email = payload.get('email')
+    if new_email and new_email.lower() != member_email.lower():
+        owner = peek(new_email)
+        if owner is not None and owner['memberId'] != member['memberId']:
+            return 'email_in_use', f"New Email {new_email} is already used by another member"
+        claimed_by = new_emails.get(new_email.lower())
+        if claimed_by is not None:
+            return 'email_in_use', f"New Email {new_email} is also the New Email of row {claimed_by}"
+        new_emails[new_email.lower()] = row_number
+    if not payload:
+        return 'no_changes', "There were no user attribute values included in the CSV for this member"
+    if not diff_payload(payload, member):
+        return 'unchanged', "The user attribute values in the CSV already match this member"
+    return 'update', None
+
+
+def plan_updates(rows, members_dict, member_types=None, journal=None):
+    """ Validates every row of a batch in one pass before any update is sent
+
+        Catches the problems the live run would otherwise only hit row by row: blank and
+        duplicate emails, emails of no active member, member types not in use, New Email values
+        already taken (the API's 409) and rows with nothing to change.
+
+        :rows:          Iterable of (member email, request payload) tuples
+        :members_dict:  Dict (or MemberCache) of member emails to member records
+        :member_types:  Optional valid member types; defaults to those of the organization's members
+        :journal:       Optional Journal; rows it records as done are left out of the plan
+
+        :returns:       Dict with the number of rows, a count per action, the rows not to send
+                        keyed by row number as (action, detail), and the number of requests the
+                        live run will send
+
+    """
+    if member_types is None:
+        member_types = get_member_types(members_dict)
+    member_types = {member_type.lower() for member_type in member_types}
+    plan = {'rows': 0, 'resumed': 0, 'counts': dict.fromkeys(PLAN_ACTIONS, 0), 'skipped': {}, 'requests': 0}
+    seen_emails = {}
+    new_emails = {}
+    for row_number, update in enumerate(rows, start=1):
+        if journal and journal.is_done(row_number, update[0]):
+            plan['resumed'] += 1
+            # Later rows for the same email are still duplicates
+            if update[0]:
+                seen_emails.setdefault(update[0].lower(), row_number)
+            continue
+        action, detail = check_member_update(row_number, update, members_dict, seen_emails, new_emails, member_types)
+        plan['rows'] += 1
+        plan['counts'][action] += 1
+        if action == 'update':
+            plan['requests'] += 1
+        else:
+            plan['skipped'][row_number] = (update[0], action, detail)
+    return plan
+
+
+def get_rejected_count(plan):
+    return sum(1 for _, action, _ in plan['skipped'].values() if action not in PLAN_NO_OPS)
+
+
+def print_plan(plan, limit=20):
+    """ Prints a compact summary of a plan: rows per action, the API calls the live run will make,
+        and the first `limit` rejected rows
+    """
+    print(f"PLAN: {plan['rows']} rows")
+    for action in PLAN_ACTIONS:
+        if plan['counts'][action]:
+            print(f"  {action:<20}{plan['counts'][action]:>8}")
+    if plan['resumed']:
+        print(f"  {'already done':<20}{plan['resumed']:>8}")
+    print(f"Estimated API calls: {plan['requests']} member updates "
+          f"({plan['rows'] - plan['requests']} rows need no request)")
+    rejected = [(row_number, entry) for row_number, entry in plan['skipped'].items() if entry[1] not in PLAN_NO_OPS]
+    if rejected:
+        print(f"Rejected rows (first {min(limit, len(rejected))} of {len(rejected)}):")
+        for row_number, (member_email, action, detail) in rejected[:limit]:
+            print(f"  row {row_number}: {member_email or '(blank)'}: {action}: {detail}")
+    print(f"###")
+
+
+def write_plan_report(plan, path):
+    """ Writes the planned action of every row not sent as an update to a CSV file """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PLAN_REPORT_COLUMNS)
+        for row_number, (member_email, action, detail) in sorted(plan['skipped'].items()):
+            writer.writerow([row_number, member_email, action, detail])
+
+
+def describe_rejected(member_email, detail):
+    return [
+        f"\u2717 UPDATE FAILURE!",
+        f"Member email: {member_email}",
+        f"Not sent, the plan rejected this row: {detail}",
+        f"###",
+    ]
+
+
+def get_planned_result(plan, row_number, update):
+    """ Result of a row the plan decided not to send
+        :returns:       Result tuple like process_member's, or None if the row is to be sent
+    """
+    entry = plan['skipped'].get(row_number)
+    if entry is None:
+        return None
+    member_email, action, detail = entry
+    if action in PLAN_NO_OPS:
+        return describe_unchanged(member_email, update[1]), False, None, True
+    if action == 'unknown_email':
+        return describe_unknown_member(member_email), True, None, False
+    return describe_rejected(member_email, detail), True, None, False
+
+
+def process_member(client, update, members_dict, skip_unchanged=False):
+    """ Updates a single member from a CSV row
+
+        :client:            SigmaClient to send the update with
+        :update:            Tuple of (member email, request payload) read from the CSV
+        :members_dict:      Dict (or MemberCache) of member emails to member records
+        :skip_unchanged:    Only send fields that differ from the member's current values
+
+        :returns:           Tuple of (output lines, whether the update failed, update latency in seconds or
+                            None, whether the request was skipped as a no-op)
+
+    """
+    member_email = update[0]
+    result, member_id, payload = plan_member_update(update, members_dict, skip_unchanged)
+    if result is not None:
+        return result
+
+    started = time.perf_counter()
+    try:
+        update_member_response = update_member(client, member_id, payload)
+    except Exception as e:
+        return describe_failure(member_email, e), True, time.perf_counter() - started, False
+    latency = time.perf_counter() - started
+    remember_update(members_dict, member_email, update_member_response)
+    return describe_success(member_email, payload, update_member_response), False, latency, False
+
+
+async def async_process_member(client, update, members_dict, skip_unchanged=False):
+    """ Updates a single member from a CSV row using an AsyncSigmaClient
+
+        :returns:       Same tuple as process_member
+
+    """
+    import asyncio
+
+    member_email = update[0]
+    if getattr(members_dict, 'lookup', None) is not None:
+        # A missing member is looked up with the blocking SigmaClient, so keep it off the event loop
+        result, member_id, payload = await asyncio.to_thread(plan_member_update, update, members_dict, skip_unchanged)
+    else:
+        result, member_id, payload = plan_member_update(update, members_dict, skip_unchanged)
+    if result is not None:
+        return result
+
+    started = time.perf_counter()
+    try:
+        update_member_response = await async_update_member(client, member_id, payload)
+    except Exception as e:
+        return describe_failure(member_email, e), True, time.perf_counter() - started, False
+    latency = time.perf_counter() - started
+    remember_update(members_dict, member_email, update_member_response)
+    return describe_success(member_email, payload, update_member_response), False, latency, False
+
+
+def report_result(stats, result):
+    """ Prints the output of one processed row and adds it to the run's stats
+
+        :stats:         Dict of run stats being accumulated
+        :result:        Tuple returned by process_member, or None if the row was skipped
+
+    """
+    if result is None:
+        return
+    lines, failed, latency, saved = result
+    print("\n".join(lines))
+    stats['processed'] += 1
+    if failed:
+        stats['failed'] += 1
+    if saved:
+        stats['saved'] += 1
+    if latency is not None:
+        stats['latencies'].append(latency)
+
+
+def record_outcome(journal, row_number, member_email, result):
+    """ Writes a processed row's outcome to the run's journal """
+    lines, failed, latency, saved = result
+    if failed:
+        journal.record(row_number, member_email, FAILED, " ".join(lines[2:-1]))
+    else:
+        journal.record(row_number, member_email, UNCHANGED if saved else SUCCEEDED)
+
+
+def get_member_keys(update):
+    """ Lower-cased emails a row's update reads or writes: the member's email, and its New Email
+        if the row changes it. Rows sharing a key are sent one after another, in CSV order.
+    """
+    member_email, payload = update
+    return {email.lower() for email in (member_email, payload.get('email')) if email}
+
+
+def run_updates(client, rows, members_dict, abort_on_update_fail=False, workers=1, skip_unchanged=False,
+                journal=None, plan=None):
+    """ Updates members from CSV rows, optionally in parallel
+
+        Output for each member is printed in CSV order regardless of which worker finishes first.
+        Rows for the same member are sent in CSV order, each after the one before it has finished,
+        so the last row wins as in a sequential run. When abort_on_update_fail is set, the first failure stops workers from starting any further
+        updates; updates already in flight are allowed to finish and are reported before aborting.
+
+        :client:                SigmaClient to send updates with
+        :rows:                  Iterable of (member email, request payload) tuples, consumed lazily
+        :members_dict:          Dict (or MemberCache) of member emails to member records
+        :abort_on_update_fail:  Stop the run after the first failed update
+        :workers:               Number of updates to run concurrently
+        :skip_unchanged:        Only send fields that differ from the members' current values
+        :journal:               Optional Journal to record each row's outcome in; rows it already records as
+                                done are skipped
+        :plan:                  Optional plan from plan_updates; rows it does not plan to update are
+                                reported without sending a request
+
+        :returns:               Dict with rows processed, failures, API calls saved, rows skipped as already
+                                done, elapsed seconds and update latencies
+
+    """
+    abort = threading.Event()
+    stats = {'processed': 0, 'failed': 0, 'saved': 0, 'resumed': 0, 'elapsed': 0.0, 'latencies': []}
+
+    def task(row_number, m, previous):
+        # Earlier rows were submitted first, so they are already running and cannot be waiting on this one
+        wait(previous)
+        if abort.is_set():
+            return None
+        result = get_planned_result(plan, row_number, m) if plan else None
+        if result is None:
+            result = process_member(client, m, members_dict, skip_unchanged)
+        if journal:
+            record_outcome(journal, row_number, m[0], result)
+        if result[1] and abort_on_update_fail:
+            abort.set()
+        return result
+
+    started = time.perf_counter()
+    # Results are consumed in submission order from a bounded window so output stays ordered
+    # and only a few rows are held in memory at a time
+    window = max(workers, 1) * 2
+    pending = deque()
+    # Latest pending row per member key, see get_member_keys
+    latest = {}
+
+    def report_next():
+        future, keys = pending.popleft()
+        report_result(stats, future.result())
+        for key in keys:
+            if latest.get(key) is future:
+                del latest[key]
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for row_number, m in enumerate(rows, start=1):
+            if abort.is_set():
+                break
+            if journal and journal.is_done(row_number, m[0]):
+                stats['resumed'] += 1
+                continue
+            keys = get_member_keys(m)
+            previous = {latest[key] for key in keys if key in latest}
+            future = executor.submit(task, row_number, m, previous)
+            latest.update(dict.fromkeys(keys, future))
+            pending.append((future, keys))
+            if len(pending) >= window:
+                report_next()
+        while pending:
+            report_next()
+    stats['elapsed'] = time.perf_counter() - started
+    stats['throttle'] = client.throttle_stats()
+
+    print_summary(stats)
+    if abort.is_set():
+        raise SystemExit("Script aborted")
+    return stats
+
+
+async def run_updates_async(client, rows, members_dict, abort_on_update_fail=False, workers=1,
+                            skip_unchanged=False, journal=None, plan=None):
+    """ Updates members from CSV rows concurrently on an AsyncSigmaClient
+
+        Behaves like run_updates, with `workers` bounding the number of in-flight requests.
+
+    """
+    import asyncio
+
+    abort = asyncio.Event()
+    semaphore = asyncio.Semaphore(max(workers, 1))
+    stats = {'processed': 0, 'failed': 0, 'saved': 0, 'resumed': 0, 'elapsed': 0.0, 'latencies': []}
+
+    async def task(row_number, m, previous):
+        if previous:
+            await asyncio.wait(previous)
+        async with semaphore:
+            if abort.is_set():
+                return None
+            result = get_planned_result(plan, row_number, m) if plan else None
+            if result is None:
+                result = await async_process_member(client, m, members_dict, skip_unchanged)
+        if journal:
+            record_outcome(journal, row_number, m[0], result)
+        if result[1] and abort_on_update_fail:
+            abort.set()
+        return result
+
+    started = time.perf_counter()
+    window = max(workers, 1) * 2
+    pending = deque()
+    latest = {}
+
+    async def report_next():
+        future, keys = pending.popleft()
+        report_result(stats, await future)
+        for key in keys:
+            if latest.get(key) is future:
+                del latest[key]
+
+    for row_number, m in enumerate(rows, start=1):
+        if abort.is_set():
+            break
+        if journal and journal.is_done(row_number, m[0]):
+            stats['resumed'] += 1
+            continue
+        keys = get_member_keys(m)
+        previous = {latest[key] for key in keys if key in latest}
+        future = asyncio.ensure_future(task(row_number, m, previous))
+        latest.update(dict.fromkeys(keys, future))
+        pending.append((future, keys))
+        if len(pending) >= window:
+            await report_next()
+    while pending:
+        await report_next()
+    stats['elapsed'] = time.perf_counter() - started
+    stats['throttle'] = client.throttle_stats()
+
+    print_summary(stats)
+    if abort.is_set():
+        raise SystemExit("Script aborted")
+    return stats
+
+
+def print_summary(stats):
+    """ Prints the throughput summary of a batch run
+
+        :stats:         Dict returned by run_updates
+
+    """
+    elapsed = stats['elapsed']
+    rate = stats['processed'] / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {stats['processed']} rows ({stats['failed']} failed) in {elapsed:.2f}s: {rate:.1f} rows/s")
+    if stats['saved']:
+        print(f"Skipped {stats['saved']} rows with nothing to change: {stats['saved']} API calls saved")
+    if stats['resumed']:
+        print(f"Skipped {stats['resumed']} rows already completed by a previous run")
+    if stats['latencies']:
+        p50 = percentile(stats['latencies'], 50) * 1000
+        p95 = percentile(stats['latencies'], 95) * 1000
+        print(f"Update latency: p50 {p50:.0f} ms, p95 {p95:.0f} ms")
+    throttle = stats.get('throttle')
+    if throttle and (throttle['throttled_seconds'] or throttle['retries']):
+        print(f"Throttled for {throttle['throttled_seconds']:.2f}s vs {throttle['useful_seconds']:.2f}s in API calls "
+              f"({throttle['throttled_responses']} throttled responses, {throttle['retries']} retries)")
+
+
+DESCRIPTION = 'Batch update organization members\' user attributes using members\' email addresses as identifiers'
+
+
+def add_arguments(parser):
     parser.add_argument(
-        '--env', type=str, required=True, help='env to use: [production | staging].')
+        '--csv', type=str, required=True, help='CSV file containing members\' email addresses and their user attributes to be updated. Column names are case sensitive. Required column: Email, Optional columns: First Name,Last Name,New Email,Member Type, isArchived')
     parser.add_argument(
-        '--cloud', type=str, required=True, help='Cloud to use: [aws | gcp | azure]')
+        '--abort_on_update_fail', type=str, required=False, help='should script abort and not try to update the next member when an attempted update fails for the current member? [enable]'
+    )
     parser.add_argument(
-        '--client_id', type=str, required=True, help='Client ID generated from within Sigma')
+        '--workers', type=int, default=1, help='Optional number of members to update concurrently (default 1)')
     parser.add_argument(
-        '--client_secret', type=str, required=True, help='Client secret API token generated from within Sigma')
+        '--rate_limit', type=float, help='Optional maximum API requests per second, backed off automatically when the API throttles')
     parser.add_argument(
-        '--csv', type=str, required=True, help='CSV file containing members\' email addresses and their user attributes to be updated. Column names are case sensitive. Required column: Email, Optional columns: First Name,Last Name,New Email,Member Type, isArchived')
+        '--use_async', action='store_true', help='Optional: send member updates with the asyncio client (requires aiohttp)')
     parser.add_argument(
-        '--abort_on_update_fail', type=str, required=False, help='should script abort and not try to update the next member when an attempted update fails for the current member? [enable]'
-    )
+        '--skip_unchanged', action='store_true', help='Optional: only send attribute values that differ from the member\'s current ones, skipping rows with nothing to change')
+    parser.add_argument(
+        '--member_cache', action='store_true', help='Optional: keep the organization\'s members in a local index so repeat runs do not download them all again')
+    parser.add_argument(
+        '--member_cache_ttl', type=int, default=3600, help='Optional seconds before the local member index is downloaded again in full (default 3600)')
+    parser.add_argument(
+        '--plan', action='store_true', help='Optional: validate the whole CSV against the member index before sending any update, then send only the rows that need one')
+    parser.add_argument(
+        '--dry_run', action='store_true', help='Optional: print the plan of --plan and exit without sending any update')
+    parser.add_argument(
+        '--plan_report', type=str, help='Optional path to write the planned action of every row that will not be sent as an update to, as CSV')
+    parser.add_argument(
+        '--member_types', type=str, nargs='+', help='Optional member types rows may set, for --plan (default: the types of the organization\'s members)')
+    parser.add_argument(
+        '--journal', type=str, help='Optional path of a file recording the outcome of each row, so an interrupted run can be resumed')
+    parser.add_argument(
+        '--resume', action='store_true', help='Optional: skip rows the --journal file records as completed and retry the rest')
+
+
+def check_arguments(parser, args):
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+    if (args.plan_report or args.member_types) and not (args.plan or args.dry_run):
+        parser.error('--plan_report and --member_types require --plan or --dry_run')
+
+
+def get_client_options(args):
+    return {
+        'pool_maxsize': max(args.workers, 1),
+        'rate_limiter': RateLimiter(args.rate_limit) if args.rate_limit else None,
+    }
 
-    args = parser.parse_args()
-    client = SigmaClient(args.env, args.cloud, args.client_id, args.client_secret)
-    
-    
-    # Get all members for the organization and make a dict of their emails and memberIds
+
+def run(args, client):
+    # Validate the CSV header before doing any work; rows are read lazily as updates are sent
     try:
-        members = get_all_members(client)
-    except Exception as e:
+        updated_members = read_member_updates(args.csv)
+    except ValueError as e:
+        print(f"\u2717 CSV FILE ERROR!")
         print(f"{e}")
+        print(f"###")
         raise SystemExit("Script aborted")
-    members_dict = {}
-    for m in members:
-        members_dict[m['email']] = m['memberId']
-
-    updated_members = []
-    with open(args.csv) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            updated_members.append(row)
 
-    for m in updated_members:
-        try:
-            if len(m['Email']) > 1:
-                member_email = m['Email']
-            else:
-                member_email = None
-        except KeyError:
-            print(f"\u2717 CSV FILE ERROR!")
-            print(f"A column titled \"Email\" is a required column in the CSV for this script to be able to run")
-            print(f"###")
-            raise SystemExit("Script aborted")
-
-        # This block of try/excepts sets the variables that get used as the request payload's values for the optional columns
-        # They will be set to None if the column itself is absent or if its value is blank/empty
-        # These KeyErrors do not apply to the --abort_on_update_flag option
-        try:
-            if len(m['First Name']) > 1:
-                member_first_name = m['First Name']
-            else:
-                member_first_name = None
-        except KeyError:
-            member_first_name = None
-        try:
-            if len(m['Last Name']) > 1:
-                member_last_name = m['Last Name']
-            else:
-                member_last_name = None
-        except KeyError:
-            member_last_name = None
-        try:
-            if len(m['New Email']) > 1:
-                member_new_email = m['New Email']
-            else:
-                member_new_email = None
-        except KeyError:
-            member_new_email = None
-        try:
-            if len(m['Member Type']) > 1:
-                member_type = m['Member Type']
-            else:
-                member_type = None
-        except KeyError:
-            member_type = None
-
-        archived_value = m.get('isArchived', None)
-        if archived_value == "True":
-            member_isArchived = True
-        elif archived_value == "False":
-            member_isArchived = False
+    # Get all members for the organization and make a dict of their emails and member records
+    try:
+        if args.member_cache:
+            members_dict = load_member_cache(client, args.member_cache_ttl)
         else:
-            member_isArchived = None
-
-        try:
-            member_id = members_dict[member_email]
-        except KeyError:
-            print(f"\u2717 UPDATE FAILURE!")
-            print(f"Member email: {member_email}")
-            print(f"This email address is either invalid, or is not found, or is for a deactivated account (reactivate the account first to change its user attributes)")
-            print(f"###")
-            if args.abort_on_update_fail == "enable":
+            members_dict = {}
+            for m in iter_members(client):
+                members_dict[m['email']] = m
+    except Exception as e:
+        print(f"{e}")
+        raise SystemExit("Script aborted")
+
+    abort_on_update_fail = args.abort_on_update_fail == "enable"
+    journal = None
+    # A dry run only reads the journal of a resumed run, to leave out the rows it would skip
+    if args.journal and (args.resume or not args.dry_run):
+        journal = Journal(args.journal, resume=args.resume)
+    try:
+        plan = None
+        if args.plan or args.dry_run:
+            plan = plan_updates(updated_members, members_dict, args.member_types, journal)
+            print_plan(plan)
+            if args.plan_report:
+                write_plan_report(plan, args.plan_report)
+            rejected = get_rejected_count(plan)
+            if args.dry_run:
+                if rejected:
+                    raise SystemExit(1)
+                return
+            if rejected and abort_on_update_fail:
+                print(f"{rejected} rows were rejected by the plan, no updates were sent")
                 raise SystemExit("Script aborted")
+            # The rows are streamed again for the live run, which only sends the planned updates
+            updated_members = read_member_updates(args.csv)
+        if args.use_async:
+            import asyncio
+
+            asyncio.run(run_async(args, client, updated_members, members_dict, abort_on_update_fail, journal, plan))
         else:
-            payload = {}
-            if member_first_name:
-                payload['firstName'] = member_first_name
-            if member_last_name:
-                payload['lastName'] = member_last_name
-            if member_new_email:
-                payload['email'] = member_new_email
-            if member_type:
-                payload['memberType'] = member_type
-            if member_isArchived is not None :
-                payload['isArchived'] = member_isArchived
-
-            try:
-                update_member_response = update_member(client, member_id, payload)
-            except Exception as e:
-                print(f"\u2717 UPDATE FAILURE!")
-                print(f"Member email: {member_email}")
-                print(f"The below API error prevented an update being applied for this member:")
-                print(f"{e}")
-                if e.args[0] == 404:
-                    print(f"If the 404 error message is \"Member type name is not found\", the Member Type specified is invalid/not in use")
-                if e.args[0] == 409:
-                    print(f"If the 409 error message is \"Duplicate record\", the New Email specified is in use by an existing member")
-                print(f"###")
-                if args.abort_on_update_fail == "enable":
-                    raise SystemExit("Script aborted")
-            else:
-                if member_first_name is None and member_last_name is None and member_new_email is None and member_type is None and member_isArchived is None:
-                    print(f"\u2013 UPDATED NOTHING!")
-                    print(f"Member email: {member_email}")
-                    print(f"There were no user attribute values included in the CSV for this member")
-                    print(f"###")
-                else:
-                    print(f"\u2713 UPDATE SUCCESS!")
-                    print(f"Member email: {member_email}")
-                    if member_first_name:
-                        print(f"First Name updated to: {update_member_response['firstName']}")
-                    if member_last_name:
-                        print(f"Last Name updated to: {update_member_response['lastName']}")
-                    if member_new_email:
-                        print(f"Email updated to: {update_member_response['email']}")
-                    if member_type:
-                        print(f"Member type updated to: {update_member_response['memberType']}")
-                    if member_isArchived is True:
-                        print(f"isArchived updated to: {update_member_response['isArchived']}")
-                    if member_isArchived is False:
-                        print(f"isArchived updated to: {update_member_response['isArchived']}")
-                    print(f"###")
+            run_updates(client, updated_members, members_dict,
+                        abort_on_update_fail=abort_on_update_fail, workers=args.workers,
+                        skip_unchanged=args.skip_unchanged, journal=journal, plan=plan)
+    finally:
+        if journal:
+            journal.close()
+
+
+def main():
+    run_command(sys.modules[__name__])
+
+
+def load_member_cache(client, ttl):
+    """ Opens the local member index, downloading all members again if it is older than ttl
+
+        Emails missing from a reused index are looked up individually; an index downloaded in this
+        run already holds every member, so nothing is looked up.
+
+        :returns:       MemberCache
+
+    """
+    cache = MemberCache(get_member_cache_path(client.base_url, client.client_id), ttl)
+    if cache.is_fresh():
+        cache.lookup = partial(find_member, client)
+        print(f"Using local member index: {len(cache)} members, refreshed {cache.age():.0f}s ago")
+    else:
+        count = cache.refresh(iter_members(client))
+        print(f"Refreshed local member index: {count} members")
+    return cache
+
+
+async def run_async(args, sync_client, rows, members_dict, abort_on_update_fail, journal=None, plan=None):
+    from async_client import AsyncSigmaClient
+
+    # Share the token, rate limit and metrics of the client that fetched the member list
+    async with AsyncSigmaClient(args.env, args.cloud, args.client_id, args.client_secret,
+                                pool_maxsize=max(args.workers, 1), rate_limiter=sync_client.rate_limiter,
+                                token_manager=sync_client.tokens, metrics=sync_client.metrics) as client:
+        await run_updates_async(client, rows, members_dict,
+                                abort_on_update_fail=abort_on_update_fail, workers=args.workers,
+                                skip_unchanged=args.skip_unchanged, journal=journal, plan=plan)
 
 if __name__ == '__main__':
     main()
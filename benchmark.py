@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from batch_update_users import iter_members, read_member_updates, run_updates
+from download import CONVERT_FORMATS
+from export_workbook import export_elements, get_workbook_schema
+from utils import SigmaClient, configure_logging
+
+# get_base_url sends --env dev to this port
+MOCK_PORT = 8081
+
+SCENARIOS = ('list_members', 'batch_update', 'export')
+
+
+def start_mock_server(args):
+    """ Starts mock_server.py in a subprocess, so its allocations and CPU do not count towards the results
+        :returns:       subprocess.Popen of the server
+    """
+    with socket.socket() as sock:
+        if sock.connect_ex(('127.0.0.1', MOCK_PORT)) == 0:
+            raise SystemExit(f"Port {MOCK_PORT} is already in use; stop whatever is listening on it first")
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py'),
+        '--port', str(MOCK_PORT), '--members', str(args.members), '--elements', str(args.elements),
+        '--export_rows', str(args.export_rows), '--export_delay', str(args.export_delay),
+        '--latency', str(args.latency), '--throttle_rate', str(args.throttle_rate),
+        '--error_rate', str(args.error_rate), '--seed', str(args.seed),
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', MOCK_PORT)) == 0:
+                return server
+        if server.poll() is not None:
+            raise SystemExit("Mock server exited during startup")
+        time.sleep(0.05)
+    server.kill()
+    raise SystemExit("Mock server did not start within 30s")
+
+
+def create_client(workers=1):
+    client = SigmaClient('dev', 'gcp', 'benchmark', 'benchmark', pool_maxsize=max(workers, 1))
+    client.tokens.token()
+    return client
+
+
+def setup_list_members(args, workdir):
+    client = create_client()
+
+    def work():
+        return sum(1 for _ in iter_members(client))
+    return client, work
+
+
+def setup_batch_update(args, workdir):
+    client = create_client(args.workers)
+    members_dict = {m['email']: m for m in iter_members(client)}
+    path = os.path.join(workdir, 'updates.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Email', 'First Name', 'Last Name'])
+        for i in range(args.rows):
+            writer.writerow([f"user{i % args.members}@example.com", f"Bench{i}", f"Mark{i}"])
+
+    def work():
+        stats = run_updates(client, read_member_updates(path), members_dict, workers=args.workers)
+        return stats['processed']
+    return client, work
+
+
+def setup_export(args, workdir):
+    client = create_client(args.max_in_flight)
+    schema = get_workbook_schema(client, 'benchmark')
+    element_ids = list(schema['elements'])
+    prefix = os.path.join(workdir, 'export')
+    conversion = None
+    if args.convert:
+        from columnar import Conversion
+        conversion = Conversion(args.convert, schema)
+
+    def work():
+        timings = export_elements(client, 'benchmark', element_ids, args.format, prefix, args.max_in_flight,
+                                  poll_interval=1, conversion=conversion)
+        return sum(timing['bytes'] for timing in timings)
+    return client, work
+
+
+# Scenario -> (setup, unit of its items). A setup returns its client and a function doing the
+# measured work, which returns the number of items it processed.
+SETUPS = {
+    'list_members': (setup_list_members, 'members'),
+    'batch_update': (setup_batch_update, 'rows'),
+    'export': (setup_export, 'bytes'),
+}
+
+
+def measure(work, trace_memory=False):
+    """ Runs the measured work once with its output discarded
+        :trace_memory:  Track peak Python memory allocated by the work with tracemalloc, which
+                        slows it down, so timed runs and the memory run are kept separate
+        :returns:       (items processed, seconds, peak bytes allocated or None)
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            items = work()
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+    return items, elapsed, peak
+
+
+def run_scenario(name, args, workdir):
+    setup, unit = SETUPS[name]
+    client, work = setup(args, workdir)
+    try:
+        runs = []
+        requests = 0
+        for _ in range(args.repeat):
+            before = client.metrics.snapshot()['requests']
+            items, elapsed, _ = measure(work)
+            requests = client.metrics.snapshot()['requests'] - before
+            runs.append(elapsed)
+        _, _, peak = measure(work, trace_memory=True)
+    finally:
+        client.close()
+    median = statistics.median(runs)
+    return {
+        'scenario': name,
+        'items': items,
+        'unit': unit,
+        'runs_seconds': runs,
+        'median_seconds': median,
+        'items_per_second': items / median if median > 0 else 0.0,
+        'peak_memory_bytes': peak,
+        'requests': requests,
+    }
+
+
+def format_rate(result):
+    if result['unit'] == 'bytes':
+        return f"{result['items_per_second'] / 1024 ** 2:.1f} MiB/s"
+    return f"{result['items_per_second']:.0f} {result['unit']}/s"
+
+
+def print_results(results, baseline=None):
+    """ Prints a table of the results, with the change from a previous run's results if given """
+    print(f"{'scenario':<14}{'items':>10}{'median':>10}{'throughput':>18}{'peak memory':>14}{'requests':>10}")
+    for result in results:
+        print(f"{result['scenario']:<14}{result['items']:>10}{result['median_seconds']:>9.3f}s{format_rate(result):>18}"
+              f"{result['peak_memory_bytes'] / 1024 ** 2:>10.2f} MiB{result['requests']:>10}")
+        previous = (baseline or {}).get(result['scenario'])
+        if previous:
+            speed = previous['median_seconds'] / result['median_seconds'] - 1 if result['median_seconds'] else 0.0
+            memory = result['peak_memory_bytes'] / previous['peak_memory_bytes'] - 1 \
+                if previous['peak_memory_bytes'] else 0.0
+            print(f"{'':<14}vs baseline: {speed:+.1%} throughput, {memory:+.1%} peak memory")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scripts against a local mock of the Sigma API (mock_server.py on port 8081)')
+    parser.add_argument(
+        '--scenarios', type=str, nargs='+', default=list(SCENARIOS), choices=SCENARIOS, help='Optional scenarios to run (default all)')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Optional number of timed runs per scenario; the median is reported (default 3)')
+    parser.add_argument(
+        '--members', type=int, default=10000, help='Optional number of members the mock organization has (default 10000)')
+    parser.add_argument(
+        '--rows', type=int, default=2000, help='Optional number of rows in the batch update CSV (default 2000)')
+    parser.add_argument(
+        '--workers', type=int, default=8, help='Optional --workers for the batch update (default 8)')
+    parser.add_argument(
+        '--elements', type=int, default=4, help='Optional number of workbook elements to export (default 4)')
+    parser.add_argument(
+        '--export_rows', type=int, default=200000, help='Optional number of rows in the largest exported element (default 200000)')
+    parser.add_argument(
+        '--export_delay', type=float, default=0.2, help='Optional seconds each mock export query takes (default 0.2)')
+    parser.add_argument(
+        '--format', type=str, default='csv', help='Optional export format: [csv | json] (default csv)')
+    parser.add_argument(
+        '--convert', type=str, choices=CONVERT_FORMATS, help='Optional: convert the exports to [parquet | arrow] as they download (requires pyarrow)')
+    parser.add_argument(
+        '--max_in_flight', type=int, default=4, help='Optional --max_in_flight for the export (default 4)')
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help='Optional seconds of latency the mock server adds to every response (default 0)')
+    parser.add_argument(
+        '--throttle_rate', type=float, default=0.0, help='Optional fraction of requests the mock server throttles with 429 (default 0)')
+    parser.add_argument(
+        '--error_rate', type=float, default=0.0, help='Optional fraction of requests the mock server fails with 503 (default 0)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='Optional seed for the mock server\'s data and injected failures (default 0)')
+    parser.add_argument(
+        '--output', type=str, help='Optional file to write the results to as JSON')
+    parser.add_argument(
+        '--baseline', type=str, help='Optional results file of a previous run to compare against')
+
+    args = parser.parse_args()
+    configure_logging('warning')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+    server = start_mock_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = [run_scenario(name, args, workdir) for name in args.scenarios]
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
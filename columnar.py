@@ -0,0 +1,328 @@
+import codecs
+import csv
+import io
+import json
+import re
+from datetime import datetime, timezone
+
+from download import CONVERT_FORMATS, DEFAULT_ROW_GROUP_SIZE, PartialDownload
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SOURCE_FORMATS = ('csv', 'json')
+
+# Whitespace, commas and brackets between the objects of a JSON array or JSON Lines export
+_JSON_SEPARATORS = re.compile(r'[\s,\[\]]*')
+
+
+class CsvRowParser():
+    """ Splits CSV text arriving in arbitrary chunks into rows
+
+        Only complete records are parsed: text after the last newline that is not inside a
+        quoted field is kept until the next chunk arrives.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, text):
+        """ :returns:       List of rows, as lists of strings, completed by this text """
+        self._buffer += text
+        end = self._buffer.rfind('\n')
+        # A newline is a record boundary only if the quotes before it are balanced
+        while end >= 0 and self._buffer.count('"', 0, end) % 2:
+            end = self._buffer.rfind('\n', 0, end)
+        if end < 0:
+            return []
+        complete, self._buffer = self._buffer[:end + 1], self._buffer[end + 1:]
+        return [row for row in csv.reader(io.StringIO(complete, newline='')) if row]
+
+    def close(self):
+        """ :returns:       Rows of a last record that had no trailing newline """
+        rest, self._buffer = self._buffer, ''
+        return [row for row in csv.reader(io.StringIO(rest, newline='')) if row]
+
+
+class JsonRowParser():
+    """ Splits a JSON array of objects, or JSON Lines, arriving in arbitrary chunks into rows """
+
+    def __init__(self):
+        self._buffer = ''
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text):
+        """ :returns:       List of rows, as dicts, completed by this text """
+        self._buffer += text
+        rows = []
+        position = 0
+        while True:
+            position = _JSON_SEPARATORS.match(self._buffer, position).end()
+            if position >= len(self._buffer):
+                break
+            try:
+                row, position = self._decoder.raw_decode(self._buffer, position)
+            except json.JSONDecodeError:
+                # The rest of the row has not arrived yet
+                break
+            if not isinstance(row, dict):
+                raise ValueError(f"Expected the JSON export to hold objects, found {type(row).__name__}")
+            rows.append(row)
+        self._buffer = self._buffer[position:]
+        return rows
+
+    def close(self):
+        if self._buffer.strip(' \t\r\n,]'):
+            raise ValueError("JSON export ended in the middle of a row")
+        self._buffer = ''
+        return []
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def to_number(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def to_integer(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def to_boolean(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 't', '1', 'yes'):
+        return True
+    if text in ('false', 'f', '0', 'no'):
+        return False
+    raise ValueError(f"{value!r} is not a boolean")
+
+
+def to_timestamp(value):
+    if value is None or value == '':
+        return None
+    timestamp = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def get_column_type(sigma_type):
+    """ Arrow type and value converter for a column type of a workbook schema
+        :sigma_type:    Type name, e.g. number, text, boolean or datetime; None if unknown
+        :returns:       (pyarrow.DataType, converter), with unknown types kept as text
+    """
+    sigma_type = (sigma_type or '').lower()
+    if sigma_type in ('number', 'float', 'double', 'decimal'):
+        return pyarrow.float64(), to_number
+    if sigma_type in ('integer', 'int'):
+        return pyarrow.int64(), to_integer
+    if sigma_type in ('boolean', 'bool', 'logical'):
+        return pyarrow.bool_(), to_boolean
+    if sigma_type in ('datetime', 'date', 'timestamp'):
+        return pyarrow.timestamp('us', tz='UTC'), to_timestamp
+    return pyarrow.string(), to_text
+
+
+def normalize_column_name(name):
+    """ Column name reduced to lower-case letters and digits, so `Order Id` matches `order_id` """
+    return re.sub(r'[^0-9a-z]', '', str(name).lower())
+
+
+def get_export_columns(schema, element_id):
+    """ Reads an element's column names and types from a workbook schema
+
+        Columns may be listed as an array or keyed by column ID, with their type either a
+        name or an object holding one.
+
+        :schema:        Response of get_workbook_schema, or None
+        :returns:       Dict of column name to type name, or None if the schema does not list
+                        the element's columns
+
+    """
+    element = ((schema or {}).get('elements') or {}).get(element_id) or {}
+    columns = element.get('columns')
+    if not columns:
+        return None
+    if isinstance(columns, dict):
+        columns = [dict(column, name=column.get('name', column_id)) for column_id, column in columns.items()]
+    types = {}
+    for column in columns:
+        column_type = column.get('type')
+        if isinstance(column_type, dict):
+            column_type = column_type.get('type')
+        types[column.get('name') or column.get('label')] = column_type
+    return types
+
+
+class ColumnarDownload(PartialDownload):
+    """ Export download converted to Parquet or Arrow IPC while it streams in
+
+        Drop-in replacement for PartialDownload: the raw CSV or JSON bytes are decoded and
+        parsed as they arrive, typed from the workbook schema, and written to `<path>.part`
+        in row groups of at most row_group_size rows, so memory use does not depend on the
+        size of the export. `written` still counts raw bytes received, so interrupted
+        downloads are resumed from the right offset.
+    """
+
+    def __init__(self, path, source_format, output_format='parquet', columns=None,
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        """ :source_format:     Format of the export: csv or json
+            :output_format:     parquet or arrow
+            :columns:           Optional dict of column name to schema type name, from get_export_columns
+            :row_group_size:    Maximum number of rows held in memory before they are written
+        """
+        if pyarrow is None:
+            raise ImportError("Converting exports requires pyarrow: pipenv install pyarrow")
+        if output_format not in CONVERT_FORMATS:
+            raise ValueError(f"Exports can be converted to {' or '.join(CONVERT_FORMATS)}, not {output_format}")
+        if source_format not in SOURCE_FORMATS:
+            raise ValueError(f"Only {' and '.join(SOURCE_FORMATS)} exports can be converted, not {source_format}")
+        self.source_format = source_format
+        self.output_format = output_format
+        self.columns = columns
+        self.row_group_size = row_group_size
+        super().__init__(path)
+        self._reset()
+
+    def _reset(self):
+        self.rows = 0
+        self.row_groups = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._parser = CsvRowParser() if self.source_format == 'csv' else JsonRowParser()
+        self._names = None
+        self._converters = None
+        self._schema = None
+        self._writer = None
+        self._pending = []
+
+    def write(self, chunk):
+        self.written += len(chunk)
+        self._add_rows(self._parser.feed(self._decoder.decode(chunk)))
+
+    def restart(self):
+        if self._writer is not None:
+            self._writer.close()
+        super().restart()
+        self._reset()
+
+    def commit(self, stats=None):
+        self._add_rows(self._parser.feed(self._decoder.decode(b'', final=True)))
+        self._add_rows(self._parser.close())
+        if self._names is None:
+            # Nothing but a header, or nothing at all: still write a file with the schema's columns
+            self._set_columns(list(self.columns or {}))
+        self._flush()
+        self._open_writer().close()
+        if stats is not None:
+            stats['rows'] = self.rows
+            stats['row_groups'] = self.row_groups
+        return super().commit(stats)
+
+    def discard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        super().discard()
+
+    def _set_columns(self, names):
+        types = self.columns or {}
+        normalized = {normalize_column_name(name): column_type for name, column_type in types.items()}
+        fields = []
+        self._converters = []
+        for name in names:
+            column_type = types[name] if name in types else normalized.get(normalize_column_name(name))
+            arrow_type, converter = get_column_type(column_type)
+            fields.append(pyarrow.field(name, arrow_type))
+            self._converters.append(converter)
+        self._names = names
+        self._name_set = set(names)
+        self._schema = pyarrow.schema(fields)
+        self._pending = [[] for _ in names]
+
+    def _add_rows(self, rows):
+        for row in rows:
+            if self._names is None:
+                # Column names come from the export itself, the CSV header or the first JSON
+                # object's keys; the schema only supplies their types
+                if self.source_format == 'csv':
+                    self._set_columns(row)
+                    continue
+                self._set_columns(list(row))
+            if isinstance(row, dict):
+                added = row.keys() - self._name_set
+                if added:
+                    raise ValueError(f"Row {self.rows + len(self._pending[0] if self._pending else ()) + 1} has columns the first row "
+                                     f"does not: {', '.join(sorted(added))}")
+                row = [row.get(name) for name in self._names]
+            # Values are converted as rows arrive so only the typed values wait for the next row group
+            for index, (values, converter) in enumerate(zip(self._pending, self._converters)):
+                value = row[index] if index < len(row) else None
+                try:
+                    values.append(converter(value))
+                except ValueError as e:
+                    field = self._schema.field(index)
+                    raise ValueError(f"Row {self.rows + len(values) + 1}, column {field.name!r}: "
+                                     f"cannot convert {value!r} to {field.type}") from e
+            if self._pending and len(self._pending[0]) >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        count = len(self._pending[0]) if self._pending else 0
+        if not count:
+            return
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(self._pending, self._schema)]
+        self._pending = [[] for _ in self._names]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self._schema)
+        writer = self._open_writer()
+        if self.output_format == 'parquet':
+            writer.write_batch(batch, row_group_size=count)
+        else:
+            writer.write_batch(batch)
+        self.rows += count
+        self.row_groups += 1
+
+    def _open_writer(self):
+        if self._writer is None:
+            if self.output_format == 'parquet':
+                self._writer = pyarrow.parquet.ParquetWriter(self._file, self._schema)
+            else:
+                self._writer = pyarrow.ipc.new_file(self._file, self._schema)
+        return self._writer
+
+
+class Conversion():
+    """ How the elements of a workbook export are converted: output format, column types and row group size """
+
+    def __init__(self, output_format='parquet', schema=None, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        """ :output_format:     parquet or arrow
+            :schema:            Optional response of get_workbook_schema to type columns from
+            :row_group_size:    Maximum number of rows held in memory before they are written
+        """
+        if pyarrow is None:
+            raise ImportError("Converting exports requires pyarrow: pipenv install pyarrow")
+        self.output_format = output_format
+        self.schema = schema
+        self.row_group_size = row_group_size
+
+    def open(self, path, source_format, element_id=None):
+        """ Starts a converted download of an element's export
+            :returns:       ColumnarDownload
+        """
+        return ColumnarDownload(path, source_format, self.output_format,
+                                get_export_columns(self.schema, element_id), self.row_group_size)
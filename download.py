@@ -0,0 +1,52 @@
+import os
+import time
+
+# Columnar formats csv and json exports can be converted to with --convert (see columnar.py)
+CONVERT_FORMATS = ('parquet', 'arrow')
+# Rows converted and written at a time, as one Parquet row group or Arrow record batch
+DEFAULT_ROW_GROUP_SIZE = 64 * 1024
+
+
+class PartialDownload():
+    """ Export download being written to `<path>.part`
+
+        The file is only renamed to its final path by commit(), so an interrupted run never
+        leaves a truncated export behind under the real name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.written = 0
+        self.resumes = 0
+        self.started = time.perf_counter()
+        self._file = open(self.part_path, 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.written += len(chunk)
+
+    def restart(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self.written = 0
+
+    def commit(self, stats=None):
+        """ Moves the completed download into place
+            :stats:         Optional dict to record bytes written, download seconds and bytes/s in
+            :returns:       Final path of the download
+        """
+        self._file.close()
+        os.replace(self.part_path, self.path)
+        if stats is not None:
+            elapsed = time.perf_counter() - self.started
+            stats['bytes'] = self.written
+            stats['download_time'] = elapsed
+            stats['bytes_per_second'] = self.written / elapsed if elapsed > 0 else 0.0
+            stats['resumes'] = self.resumes
+        return self.path
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Default size the cache is trimmed to, in bytes
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+INDEX_FILE = 'index.json'
+
+
+def get_cache_key(workbook_id, element_id, export_format, version):
+    """ Name of the cache entry for an element's export at a workbook version """
+    key = json.dumps([workbook_id, element_id, export_format, version])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ExportCache():
+    """ Local cache of element exports, keyed by workbook, element, format and workbook version
+
+        Exports are copied into the cache directory after they download, and copied back out
+        when the same element is exported again at the same workbook version, without running
+        its query. The index of entries is kept in `index.json` alongside them. When the cache
+        grows beyond max_bytes, the least recently used entries are evicted.
+
+        Safe to use from several threads, but not from several processes at once.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """ :directory:     Cache directory, created if missing
+            :max_bytes:     Size the cache is trimmed to after each new entry
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries = self._load()
+        # max_bytes may be smaller than when the cache was last used
+        self._evict()
+        self._save()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Entries whose file was deleted behind our back are forgotten
+        return {key: entry for key, entry in entries.items() if os.path.exists(self._path(key))}
+
+    def _save(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(f"{path}.part", 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(f"{path}.part", path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, workbook_id, element_id, export_format, version, path):
+        """ Copies a cached export to path
+
+            :export_format: Format the export was saved in, see get_cache_format
+            :version:       Workbook version the export must have been taken at
+            :path:          Destination, written via `<path>.part` like a download
+
+            :returns:       Size of the export in bytes, or None if it is not cached
+
+        """
+        key = get_cache_key(workbook_id, element_id, export_format, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self._path(key)):
+                self._entries.pop(key, None)
+                return None
+            entry['last_used'] = time.time()
+            # Copied under the lock so the entry cannot be evicted halfway through
+            shutil.copyfile(self._path(key), f"{path}.part")
+            self._save()
+        os.replace(f"{path}.part", path)
+        return entry['bytes']
+
+    def put(self, workbook_id, element_id, export_format, version, path):
+        """ Adds a completed export to the cache, then evicts entries until the cache fits in max_bytes
+            :path:          The export's file, which is copied
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+        key = get_cache_key(workbook_id, element_id, export_format, version)
+        with self._lock:
+            shutil.copyfile(path, f"{self._path(key)}.part")
+            os.replace(f"{self._path(key)}.part", self._path(key))
+            self._entries[key] = {
+                'workbook_id': workbook_id, 'element_id': element_id, 'format': export_format, 'version': version,
+                'bytes': size, 'last_used': time.time(),
+            }
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        total = sum(entry['bytes'] for entry in self._entries.values())
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entry['bytes']
+            del self._entries[key]
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+
+def get_cache_format(export_format, conversion=None):
+    """ Format an export is cached under: the export format, plus the output format if converted """
+    if conversion is None:
+        return export_format
+    return f"{export_format}.{conversion.output_format}"
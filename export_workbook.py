@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
-import argparse
+import csv
 import json
+import logging
+import os
+import random
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils import SigmaClient
+import requests
+
+from download import CONVERT_FORMATS, DEFAULT_ROW_GROUP_SIZE, PartialDownload
+from export_cache import DEFAULT_MAX_BYTES, ExportCache, get_cache_format
+from utils import run_command
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger('sigma.export')
 
 
 def get_workbook_schema(client, workbook_id):
@@ -22,6 +35,32 @@ def get_workbook_schema(client, workbook_id):
     return response.json()
 
 
+def get_workbook_version(client, workbook_id):
+    """ Gets the version of the workbook, which changes whenever the workbook is saved
+
+        :workbook_id:   ID of workbook
+
+        :returns:       Version string made of the workbook's latestVersion and updatedAt, or None
+                        if the workbook metadata could not be read
+
+    """
+    response = client.get(
+        f"v2/workbooks/{workbook_id}",
+    )
+    return read_workbook_version(workbook_id, response)
+
+
+def read_workbook_version(workbook_id, response):
+    if response.status_code != 200:
+        logger.warning("Could not read workbook version, not using the export cache",
+                       extra={'fields': {'workbook_id': workbook_id, 'status': response.status_code}})
+        return None
+    workbook = response.json()
+    if workbook.get('latestVersion') is None and workbook.get('updatedAt') is None:
+        return None
+    return f"{workbook.get('latestVersion')}@{workbook.get('updatedAt')}"
+
+
 def export_workbook(client, workbook_id, export_format='json', element_id=None, retries=5):
     """ Exports workbook to file
 
@@ -44,81 +83,922 @@ def export_workbook(client, workbook_id, export_format='json', element_id=None,
         f"v2/workbooks/{workbook_id}/export",
         json=payload
     )
-    try:
-        query_id = response.json()['queryId']
-        return query_id
-    except:
-        err = {'status_code': response.status_code, 'content': response.text, 'retries': retries}
-        print(f'error: {err}')
-        if retries < 0:
-            raise
+    query_id = check_export_started(response, workbook_id, element_id, retries)
+    if query_id is None:
         return export_workbook(client, workbook_id, export_format, element_id, retries - 1)
+    return query_id
+
+
+def check_export_started(response, workbook_id, element_id=None, retries=0):
+    """ Reads the ID of the export query from a response of the export endpoint
+
+        :retries:       Attempts left; the export fails once they run out
+
+        :returns:       ID of the export query, or None if the request should be sent again
+
+    """
+    try:
+        return response.json()['queryId']
+    except (ValueError, KeyError):
+        pass
+    err = {'status_code': response.status_code, 'content': response.text, 'retries': retries}
+    logger.warning("Export request failed", extra={'fields': err})
+    # A 4xx, such as an unknown element, fails the same way however often it is sent
+    if retries < 0 or 400 <= response.status_code < 500:
+        try:
+            message = response.json()['message']
+        except (ValueError, KeyError, TypeError):
+            message = response.text
+        target = f"element {element_id} of workbook {workbook_id}" if element_id else f"workbook {workbook_id}"
+        raise Exception(response.status_code, f"Export of {target} failed: {message}")
+    return None
+
+
+def get_poll_delays(initial_interval=0.5, max_interval=10, factor=2):
+    """ Yields how long to wait before each poll of an export query
+
+        Starts with a quick check and backs off exponentially up to max_interval. Each delay is
+        jittered so that many queries polled at once do not hit the API in lockstep.
+
+        :initial_interval:  Seconds before the first poll
+        :max_interval:      Maximum seconds between polls
+        :factor:            Growth factor of the interval after each poll
+
+    """
+    interval = initial_interval
+    while True:
+        yield random.uniform(interval / 2, interval)
+        interval = min(interval * factor, max_interval)
+
+
+def check_results(response, query_id):
+    """ Interprets a response of the query download endpoint
+
+        :returns:       The response when the results are ready, or None while the query is still running
 
+    """
+    if response.status_code == 200:
+        return response
+    if response.status_code != 204:
+        # A streamed response's body can no longer be read once it is closed
+        message = response.text
+        response.close()
+        raise Exception(response.status_code, f"Export query {query_id} failed: {message}")
+    response.close()
+    return None
+
+
+def wait_for_results(client, query_id, max_interval=10, timeout=3600, stats=None, stream=False):
+    """ Polls an export query until its results are ready
+
+        :query_id:      ID of the export query
+        :max_interval:  Maximum seconds between polls
+        :timeout:       Seconds to wait for the query before giving up
+        :stats:         Optional dict to record the number of polls and seconds spent polling in
+        :stream:        Leave the body of the returned response unread so it can be streamed
 
-def retrieve_results(client, query_id):
+        :returns:       Response of the download endpoint holding the export contents
+
+    """
+    started = time.monotonic()
+    delays = get_poll_delays(max_interval=max_interval)
+    polls = 0
     res = None
-    while res is None:
-        time.sleep(10)
+    try:
+        while res is None:
+            remaining = started + timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Export query {query_id} did not finish within {timeout}s ({polls} polls)")
+            time.sleep(min(next(delays), remaining))
+
+            response = client.get(
+                f'v2/query/{query_id}/download',
+                stream=stream
+            )
+            polls += 1
+            res = check_results(response, query_id)
+    finally:
+        if stats is not None:
+            stats['polls'] = polls
+            stats['poll_time'] = time.monotonic() - started
+    return res
+
+
+def retrieve_results(client, query_id, max_interval=10, timeout=3600, stats=None):
+    """ Polls an export query until its results are ready and returns them in memory
+
+        Prefer download_results for large exports.
+
+        :returns:       Export contents
+
+    """
+    return wait_for_results(client, query_id, max_interval, timeout, stats).content
+
+
+def get_expected_size(response):
+    """ Total size of the export according to the response headers
+        :returns:       Size in bytes, or None if the server did not say or the body is compressed
+    """
+    if response.headers.get('Content-Encoding'):
+        return None
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    content_length = response.headers.get('Content-Length')
+    return int(content_length) if content_length else None
+
+
+def get_resume_headers(download, response):
+    """ Headers for re-requesting the rest of an interrupted download
+
+        :returns:       Range header if the server accepts byte ranges, otherwise no headers (the
+                        download starts over)
+
+    """
+    if download.written and response.headers.get('Accept-Ranges') == 'bytes' \
+            and not response.headers.get('Content-Encoding'):
+        return {'Range': f'bytes={download.written}-'}
+    return {}
+
+
+def check_resumed(download, response, query_id):
+    """ Prepares a download for the response of a resume request """
+    if response.status_code == 200:
+        download.restart()
+    elif response.status_code != 206:
+        response.close()
+        raise Exception(response.status_code, f"Resuming download of export query {query_id} failed: {response.text}")
+    download.resumes += 1
+
+
+def download_results(client, query_id, path, max_interval=10, timeout=3600, stats=None, resume_attempts=5,
+                     open_download=PartialDownload):
+    """ Waits for an export query and streams its results to a file
+
+        The results are written in chunks to `<path>.part`, which is atomically renamed to
+        path when complete, so memory use does not grow with the size of the export. If the
+        connection drops mid-download, the rest is requested with an HTTP Range header when the
+        server supports it, or the download starts over when it does not.
+
+        :query_id:          ID of the export query
+        :path:              Path to write the export to
+        :max_interval:      Maximum seconds between polls
+        :timeout:           Seconds to wait for the query before giving up
+        :stats:             Optional dict to record poll and download stats in
+        :resume_attempts:   Number of times an interrupted download is resumed before giving up
+        :open_download:     Callable opening the PartialDownload the results are written to, e.g. a
+                            ColumnarDownload to convert them on the way
+
+        :returns:           Path of the written export
+
+    """
+    response = wait_for_results(client, query_id, max_interval, timeout, stats, stream=True)
+    download = open_download(path)
+    try:
+        while True:
+            try:
+                expected = get_expected_size(response)
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    download.write(chunk)
+                if expected and download.written < expected:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Download ended after {download.written} of {expected} bytes")
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                response.close()
+                if download.resumes >= resume_attempts:
+                    raise
+                headers = get_resume_headers(download, response)
+                response = client.get(f'v2/query/{query_id}/download', headers=headers, stream=True)
+                check_resumed(download, response, query_id)
+    except BaseException:
+        download.discard()
+        raise
+    finally:
+        response.close()
+    return download.commit(stats)
+
+
+async def async_get_workbook_schema(client, workbook_id):
+    """ Gets the workbook's schema using an AsyncSigmaClient """
+    response = await client.get(
+        f"v2/workbooks/{workbook_id}/schema",
+    )
+    return response.json()
+
 
-        response = client.get(
-            f'v2/query/{query_id}/download',
+async def async_get_workbook_version(client, workbook_id):
+    """ Gets the version of the workbook using an AsyncSigmaClient """
+    response = await client.get(
+        f"v2/workbooks/{workbook_id}",
+    )
+    return read_workbook_version(workbook_id, response)
+
+
+async def async_export_workbook(client, workbook_id, export_format='json', element_id=None, retries=5):
+    """ Starts a workbook export using an AsyncSigmaClient
+
+        :returns:       ID of the export query
+
+    """
+    payload = {
+        "format": {
+            "type": export_format
+        }
+    }
+    if element_id:
+        payload["elementId"] = element_id
+
+    while True:
+        response = await client.post(
+            f"v2/workbooks/{workbook_id}/export",
+            json=payload
         )
-        if response.status_code == 200:
-            res = response.content
-        elif response.status_code != 204:
-            print(f'status: {response.status_code}, content: {response.text}')
+        query_id = check_export_started(response, workbook_id, element_id, retries)
+        if query_id is not None:
+            return query_id
+        retries -= 1
+
+
+async def async_wait_for_results(client, query_id, max_interval=10, timeout=3600, stats=None, stream=False):
+    """ Polls an export query using an AsyncSigmaClient until its results are ready
+
+        Same arguments as wait_for_results.
+
+    """
+    import asyncio
+
+    started = time.monotonic()
+    delays = get_poll_delays(max_interval=max_interval)
+    polls = 0
+    res = None
+    try:
+        while res is None:
+            remaining = started + timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Export query {query_id} did not finish within {timeout}s ({polls} polls)")
+            await asyncio.sleep(min(next(delays), remaining))
+
+            response = await client.get(
+                f'v2/query/{query_id}/download',
+                stream=stream
+            )
+            polls += 1
+            res = check_results(response, query_id)
+    finally:
+        if stats is not None:
+            stats['polls'] = polls
+            stats['poll_time'] = time.monotonic() - started
     return res
 
 
+async def async_retrieve_results(client, query_id, max_interval=10, timeout=3600, stats=None):
+    """ Polls an export query using an AsyncSigmaClient and returns its results in memory """
+    response = await async_wait_for_results(client, query_id, max_interval, timeout, stats)
+    return response.content
+
+
+async def async_download_results(client, query_id, path, max_interval=10, timeout=3600, stats=None,
+                                 resume_attempts=5, open_download=PartialDownload):
+    """ Waits for an export query and streams its results to a file using an AsyncSigmaClient
+
+        Same arguments and behaviour as download_results.
+
+    """
+    response = await async_wait_for_results(client, query_id, max_interval, timeout, stats, stream=True)
+    download = open_download(path)
+    try:
+        while True:
+            try:
+                expected = get_expected_size(response)
+                async for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    download.write(chunk)
+                if expected and download.written < expected:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Download ended after {download.written} of {expected} bytes")
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                response.close()
+                if download.resumes >= resume_attempts:
+                    raise
+                headers = get_resume_headers(download, response)
+                response = await client.get(f'v2/query/{query_id}/download', headers=headers, stream=True)
+                check_resumed(download, response, query_id)
+    except BaseException:
+        download.discard()
+        raise
+    finally:
+        response.close()
+    return download.commit(stats)
+
+
+async def async_export_elements(args, sync_client):
+    """ Exports every element of a workbook concurrently using an AsyncSigmaClient
+
+        :sync_client:   SigmaClient whose token and metrics the AsyncSigmaClient shares
+
+    """
+    import asyncio
+
+    from async_client import AsyncSigmaClient
+
+    async with AsyncSigmaClient(args.env, args.cloud, args.client_id, args.client_secret,
+                                token_manager=sync_client.tokens, metrics=sync_client.metrics) as client:
+        schema = await async_get_workbook_schema(client, args.workbook_id)
+        elements = schema["elements"]
+        logger.info("Exporting workbook elements",
+                    extra={'fields': {'workbook_id': args.workbook_id, 'elements': list(elements)}})
+        filename = args.filename if args.filename else args.workbook_id
+        conversion = get_conversion(args, schema)
+        cache = get_cache(args)
+        version = await async_get_workbook_version(client, args.workbook_id) if cache else None
+        semaphore = asyncio.Semaphore(max(args.max_in_flight, 1))
+        submitted = time.perf_counter()
+
+        async def export_element(element_id):
+            async with semaphore:
+                started = time.perf_counter()
+                timing = {'element_id': element_id, 'queue_time': started - submitted}
+                path = get_output_path(filename, conversion.output_format if conversion else args.format, element_id)
+                cache_format = get_cache_format(args.format, conversion)
+                if version and not args.force and await asyncio.to_thread(
+                        copy_cached_export, cache, args.workbook_id, element_id, cache_format, version, path, timing):
+                    timing['wall_time'] = time.perf_counter() - started
+                    return timing
+                query_id = await async_export_workbook(client, args.workbook_id, args.format, element_id)
+                await async_download_results(client, query_id, path, args.poll_interval, args.poll_timeout, timing,
+                                             open_download=get_download_opener(args.format, element_id, conversion))
+                if version:
+                    await asyncio.to_thread(cache.put, args.workbook_id, element_id, cache_format, version, path)
+                timing['wall_time'] = time.perf_counter() - started
+                return timing
+
+        timings = await asyncio.gather(*[export_element(element_id) for element_id in elements])
+        print_export_report(timings, time.perf_counter() - submitted)
+
+
+def export_element(client, workbook_id, element_id, export_format, filename, submitted, poll_interval=10,
+                   poll_timeout=3600, conversion=None, cache=None, version=None, force=False):
+    """ Exports one workbook element and streams it to file
+
+        :submitted:     perf_counter() value of when the export was queued
+        :poll_interval: Maximum seconds between polls of the export query
+        :poll_timeout:  Seconds to wait for the export query before giving up
+        :conversion:    Optional columnar.Conversion to convert the export with as it downloads
+        :cache:         Optional ExportCache to copy the export from instead of running its query, and
+                        to add it to once downloaded
+        :version:       Workbook version the cached export must match; without it the cache is not used
+        :force:         Re-export even if the export is cached
+
+        :returns:       Dict with the element ID, output path, seconds spent queued and exporting, number
+                        of polls and download stats, with cached set if it came from the cache
+
+    """
+    started = time.perf_counter()
+    timing = {'element_id': element_id, 'queue_time': started - submitted}
+    path = get_output_path(filename, conversion.output_format if conversion else export_format, element_id)
+    timing['path'] = path
+    cache_format = get_cache_format(export_format, conversion)
+    use_cache = cache is not None and version is not None
+    if use_cache and not force and copy_cached_export(cache, workbook_id, element_id, cache_format, version, path,
+                                                      timing):
+        timing['wall_time'] = time.perf_counter() - started
+        return timing
+    query_id = export_workbook(client, workbook_id, export_format, element_id)
+    download_results(client, query_id, path, poll_interval, poll_timeout, timing,
+                     open_download=get_download_opener(export_format, element_id, conversion))
+    if use_cache:
+        cache.put(workbook_id, element_id, cache_format, version, path)
+    timing['wall_time'] = time.perf_counter() - started
+    return timing
+
+
+def export_elements(client, workbook_id, element_ids, export_format='json', filename=None, max_in_flight=1,
+                    poll_interval=10, poll_timeout=3600, conversion=None, cache=None, version=None, force=False):
+    """ Exports workbook elements concurrently
+
+        All elements are queued up front and at most max_in_flight export queries run at once.
+        Each element's results are written as soon as its query completes.
+
+        :element_ids:   IDs of the elements to export
+        :filename:      Filename prefix, defaults to the workbook ID
+        :max_in_flight: Maximum number of export queries running at the same time
+        :poll_interval: Maximum seconds between polls of each export query
+        :poll_timeout:  Seconds to wait for each export query before giving up
+        :conversion:    Optional columnar.Conversion to convert each export with as it downloads
+        :cache:         Optional ExportCache, used for the elements when version is given
+        :version:       Workbook version, from get_workbook_version
+        :force:         Re-export elements even if they are cached
+
+        :returns:       List of per-element timings in completion order
+
+    """
+    filename = filename if filename else workbook_id
+    timings = []
+    submitted = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(max_in_flight, 1)) as executor:
+        futures = [
+            executor.submit(export_element, client, workbook_id, element_id, export_format, filename, submitted,
+                            poll_interval, poll_timeout, conversion, cache, version, force)
+            for element_id in element_ids
+        ]
+        for future in as_completed(futures):
+            timing = future.result()
+            print(f"Exported element {timing['element_id']} in {timing['wall_time']:.1f}s")
+            timings.append(timing)
+    print_export_report(timings, time.perf_counter() - submitted)
+    return timings
+
+
+def print_export_report(timings, elapsed):
+    """ Prints how long each element spent queued and exporting
+
+        :timings:       Per-element timings returned by export_element
+        :elapsed:       Wall-clock seconds for the whole export
+
+    """
+    print(f"Exported {len(timings)} elements in {elapsed:.1f}s")
+    for timing in sorted(timings, key=lambda t: t['wall_time'], reverse=True):
+        print(f"{timing['element_id']}: export {timing['wall_time']:.1f}s, queued {timing['queue_time']:.1f}s, "
+              f"{timing['polls']} polls, {format_download_stats(timing)}")
+
+
+def format_download_stats(stats):
+    if stats.get('cached'):
+        return f"{stats['bytes']} bytes copied from cache"
+    text = f"{stats['bytes']} bytes at {stats['bytes_per_second'] / 1024 / 1024:.1f} MiB/s"
+    if 'rows' in stats:
+        text += f", {stats['rows']} rows converted in {stats['row_groups']} row groups"
+    return text
+
+
+def get_conversion(args, schema=None):
+    """ Conversion requested on the command line
+        :schema:        Workbook schema to type the converted columns from
+        :returns:       columnar.Conversion, or None to keep exports in the format they are downloaded in
+    """
+    if not args.convert:
+        return None
+    from columnar import Conversion
+    return Conversion(args.convert, schema, args.row_group_size)
+
+
+def get_cache(args):
+    """ Export cache requested on the command line
+        :returns:       ExportCache, or None to always export
+    """
+    if not args.cache_dir:
+        return None
+    return ExportCache(args.cache_dir, int(args.cache_max_mb * 1024 * 1024))
+
+
+def copy_cached_export(cache, workbook_id, element_id, export_format, version, path, stats):
+    """ Copies an element's export from the cache instead of exporting it
+
+        :export_format: Format the export is cached under, from get_cache_format
+        :stats:         Dict to record the size, copy time, and cached flag in
+
+        :returns:       Whether the export was cached
+
+    """
+    started = time.perf_counter()
+    size = cache.fetch(workbook_id, element_id, export_format, version, path)
+    if size is None:
+        return False
+    elapsed = time.perf_counter() - started
+    stats.update({'cached': True, 'polls': 0, 'resumes': 0, 'bytes': size, 'download_time': elapsed,
+                  'bytes_per_second': size / elapsed if elapsed > 0 else 0.0})
+    logger.info("Copied export from cache", extra={'fields': {
+        'workbook_id': workbook_id, 'element_id': element_id, 'version': version, 'path': path}})
+    return True
+
+
+def get_download_opener(export_format, element_id=None, conversion=None):
+    """ Callable opening the download an element's export is written to
+        :returns:       PartialDownload, or a function opening a ColumnarDownload when converting
+    """
+    if conversion is None:
+        return PartialDownload
+    return lambda path: conversion.open(path, export_format, element_id)
+
+
+def get_output_path(filename, export_format='json', element_id=None):
+    """ Path an export is written to
+        :filename:      Filename prefix
+        :element_id:    Optional element ID if multiple exports
+    """
+    if element_id:
+        filename = f"{filename}_{element_id}"
+    return f"{filename}.{export_format}"
+
+
 def write_to_file(filename, content, export_format='json', element_id=None):
     """ Writes export result to file
         :filename:      Filename to write to
         :data:          JSON data to write
         :element_id:    Optional element ID if multiple exports
     """
-    if element_id:
-        filename = f"{filename}_{element_id}"
-
-    with open(f"{filename}.{export_format}", 'wb') as f:
+    with open(get_output_path(filename, export_format, element_id), 'wb') as f:
         f.write(content)
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Export a workbook from Sigma into JSON')
+MANIFEST_REQUIRED_COLUMNS = ('Workbook ID',)
+MANIFEST_REPORT_COLUMNS = ('Workbook ID', 'Element ID', 'Format', 'Priority', 'Status', 'Path', 'Bytes', 'Rows',
+                           'Polls', 'Queue Seconds', 'Export Seconds', 'Error')
+PRIORITIES = ('small_first', 'manifest')
+# Kinds of size estimate small_first orders by, in the order their elements start
+SIZE_SOURCES = ('history', 'rows')
+
+
+def read_manifest(path, default_format='json', default_filename=None):
+    """ Reads the export targets from a manifest CSV file
+
+        Required column: Workbook ID.
+        Optional columns: Element ID (blank exports every element of the workbook), Format
+        (overrides --format), Filename (prefix, defaults to the workbook ID, or to
+        `<default_filename>_<workbook ID>` so workbooks do not share it) and Priority (lower
+        runs first).
+
+        :returns:       List of targets as dicts
+
+    """
+    with open(path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        missing = [c for c in MANIFEST_REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"The manifest is missing required columns: {', '.join(missing)}")
+        targets = []
+        for line, row in enumerate(reader, start=2):
+            workbook_id = (row.get('Workbook ID') or '').strip()
+            if not workbook_id:
+                raise ValueError(f"Line {line} of the manifest has no Workbook ID")
+            priority = (row.get('Priority') or '').strip()
+            try:
+                priority = float(priority) if priority else None
+            except ValueError:
+                raise ValueError(f"Line {line} of the manifest has an invalid Priority: {priority}")
+            targets.append({
+                'workbook_id': workbook_id,
+                'element_id': (row.get('Element ID') or '').strip() or None,
+                'format': (row.get('Format') or '').strip().lower() or default_format,
+                'filename': (row.get('Filename') or '').strip() or
+                            (f"{default_filename}_{workbook_id}" if default_filename else workbook_id),
+                'priority': priority,
+                'order': len(targets),
+            })
+        return targets
+
+
+def get_workbook_schemas(client, workbook_ids, workers=1):
+    """ Fetches the schema of each workbook once, however many targets refer to it
+
+        :workbook_ids:  IDs of the workbooks
+        :workers:       Number of schemas fetched at the same time
+
+        :returns:       Dict of workbook ID to its schema, or to the exception raised fetching it
+
+    """
+    def fetch(workbook_id):
+        try:
+            schema = get_workbook_schema(client, workbook_id)
+            if 'elements' not in schema:
+                raise Exception(f"Workbook {workbook_id} has no schema: {schema.get('message', schema)}")
+            return schema
+        except Exception as e:
+            return e
+
+    workbook_ids = list(dict.fromkeys(workbook_ids))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return dict(zip(workbook_ids, executor.map(fetch, workbook_ids)))
+
+
+def get_workbook_versions(client, workbook_ids, workers=1):
+    """ Fetches the version of each workbook once, for the export cache
+        :returns:       Dict of workbook ID to its version, or to None if it could not be fetched
+    """
+    def fetch(workbook_id):
+        try:
+            return get_workbook_version(client, workbook_id)
+        except Exception as e:
+            logger.warning("Could not read workbook version, not using the export cache",
+                           extra={'fields': {'workbook_id': workbook_id, 'error': str(e)}})
+            return None
+
+    workbook_ids = list(dict.fromkeys(workbook_ids))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return dict(zip(workbook_ids, executor.map(fetch, workbook_ids)))
+
+
+def expand_targets(targets, schemas):
+    """ Replaces whole-workbook targets with one target per element, dropping duplicates
+
+        The first listing of a workbook element and format wins. Targets whose workbook schema
+        could not be fetched are kept with the error, to be reported as failed.
+
+        :returns:       List of element targets
+
+    """
+    expanded = []
+    seen = set()
+    for target in targets:
+        schema = schemas.get(target['workbook_id'])
+        if isinstance(schema, Exception):
+            element_ids = [target['element_id']]
+        elif target['element_id'] is None:
+            element_ids = list(schema['elements'])
+        else:
+            element_ids = [target['element_id']]
+        for element_id in element_ids:
+            key = (target['workbook_id'], element_id, target['format'])
+            if key in seen:
+                continue
+            seen.add(key)
+            expanded.append(dict(target, element_id=element_id,
+                                 error=str(schema) if isinstance(schema, Exception) else None))
+    return expanded
+
+
+def check_output_paths(targets, output_format=None):
+    """ Fails if two targets would be exported to the same file
+
+        :output_format: Format exports are converted to, if any, which sets their file extension
+
+    """
+    paths = {}
+    for target in targets:
+        if target.get('error'):
+            continue
+        path = get_output_path(target['filename'], output_format or target['format'], target['element_id'])
+        other = paths.setdefault(path, target)
+        if other is not target:
+            raise ValueError(f"Workbook {other['workbook_id']} element {other['element_id']} ({other['format']}) and "
+                             f"workbook {target['workbook_id']} element {target['element_id']} ({target['format']}) "
+                             f"would both be exported to {path}; give them different Filename values in the manifest")
+
+
+def read_export_history(path):
+    """ Reads the sizes of elements exported by a previous run from its report
+        :returns:       Dict of (workbook ID, element ID, format) to bytes
+    """
+    with open(path, newline='') as csvfile:
+        return {
+            (row['Workbook ID'], row['Element ID'], row['Format']): int(row['Bytes'])
+            for row in csv.DictReader(csvfile) if row.get('Bytes')
+        }
+
+
+def estimate_size(target, schemas, history):
+    """ Best guess of how large an element's export is
+
+        Uses the size the element had in a previous run's report, or the row count in its
+        workbook schema if the schema has one. Bytes and rows cannot be compared with each
+        other, so the estimate says which of the two it is.
+
+        :returns:       Tuple of (source, size), source being one of SIZE_SOURCES: 'history' for a
+                        size in bytes, 'rows' for a row count; or None if unknown
+
+    """
+    key = (target['workbook_id'], target['element_id'], target['format'])
+    if key in history:
+        return 'history', history[key]
+    schema = schemas.get(target['workbook_id'])
+    if isinstance(schema, dict):
+        element = schema['elements'].get(target['element_id']) or {}
+        if isinstance(element, dict) and element.get('rowCount') is not None:
+            return 'rows', element['rowCount']
+    return None
+
+
+def schedule_targets(targets, schemas, history=None, priority='small_first'):
+    """ Orders the targets in which their exports are started
+
+        Targets with a Priority run first, lowest first. The rest run smallest first with
+        priority small_first, or in manifest order with priority manifest. Sizes are only
+        compared between estimates of the same kind: elements sized by the history run first,
+        then those sized by their schema row count, then those of unknown size.
+
+        :history:       Optional dict from read_export_history
+        :returns:       Sorted list of targets
+
+    """
+    history = history or {}
+
+    def key(target):
+        if target['priority'] is not None:
+            return (0, target['priority'], 0, target['order'])
+        estimate = estimate_size(target, schemas, history) if priority == 'small_first' else None
+        if estimate is None:
+            return (1 + len(SIZE_SOURCES), 0, 0, target['order'])
+        source, size = estimate
+        return (1 + SIZE_SOURCES.index(source), 0, size, target['order'])
+
+    return sorted(targets, key=key)
+
+
+def export_target(client, target, submitted, poll_interval=10, poll_timeout=3600, conversion=None, cache=None,
+                  version=None, force=False):
+    """ Exports one manifest target, recording rather than raising any error
+        :returns:       Dict with the target's report row
+    """
+    result = {
+        'Workbook ID': target['workbook_id'], 'Element ID': target['element_id'], 'Format': target['format'],
+        'Priority': '' if target['priority'] is None else f"{target['priority']:g}", 'Status': 'failed', 'Error': '',
+    }
+    if target.get('error'):
+        result['Error'] = target['error']
+        return result
+    try:
+        timing = export_element(client, target['workbook_id'], target['element_id'], target['format'],
+                                target['filename'], submitted, poll_interval, poll_timeout, conversion, cache,
+                                version, force)
+    except Exception as e:
+        result['Error'] = str(e)
+        return result
+    result.update({
+        'Status': 'cached' if timing.get('cached') else 'exported', 'Path': timing['path'], 'Bytes': timing['bytes'], 'Rows': timing.get('rows', ''),
+        'Polls': timing['polls'], 'Queue Seconds': f"{timing['queue_time']:.1f}",
+        'Export Seconds': f"{timing['wall_time']:.1f}",
+    })
+    return result
+
+
+def export_targets(client, targets, max_in_flight=1, poll_interval=10, poll_timeout=3600, conversions=None,
+                   cache=None, versions=None, force=False):
+    """ Exports manifest targets with one limit on the number of export queries running at once
+
+        Targets are started in the order given, as earlier ones finish. A failed export is
+        reported and does not stop the others.
+
+        :targets:       Targets in the order to start them, from schedule_targets
+        :conversions:   Optional dict of workbook ID to the columnar.Conversion for its elements
+        :cache:         Optional ExportCache, used for the workbooks with a version
+        :versions:      Optional dict of workbook ID to its version, from get_workbook_versions
+        :force:         Re-export elements even if they are cached
+
+        :returns:       List of report rows in completion order
+
+    """
+    conversions = conversions or {}
+    versions = versions or {}
+    results = []
+    submitted = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(max_in_flight, 1)) as executor:
+        futures = [
+            executor.submit(export_target, client, target, submitted, poll_interval, poll_timeout,
+                            conversions.get(target['workbook_id']), cache, versions.get(target['workbook_id']), force)
+            for target in targets
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            fields = {'workbook_id': result['Workbook ID'], 'element_id': result['Element ID']}
+            if result['Status'] == 'cached':
+                logger.info("Copied element export from cache", extra={'fields': fields})
+            elif result['Status'] == 'exported':
+                logger.info("Exported element",
+                            extra={'fields': dict(fields, seconds=float(result['Export Seconds']))})
+            else:
+                logger.warning("Element export failed", extra={'fields': dict(fields, error=result['Error'])})
+            results.append(result)
+    failed = sum(1 for result in results if result['Status'] == 'failed')
+    logger.info("Exported manifest", extra={'fields': {
+        'elements': len(results), 'failed': failed, 'workbooks': len({result['Workbook ID'] for result in results}),
+        'seconds': round(time.perf_counter() - submitted, 1)}})
+    return results
+
+
+def write_export_report(results, path=None):
+    """ Writes the per-element results of a manifest run as CSV to path, or to stdout """
+    out = open(path, 'w', newline='') if path else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=MANIFEST_REPORT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+    finally:
+        if path:
+            out.close()
+
+
+def run_manifest(args, client):
+    targets = read_manifest(args.manifest, args.format, args.filename)
+    if args.convert:
+        unconvertible = {target['format'] for target in targets} - {'csv', 'json'}
+        if unconvertible:
+            raise ValueError(f"--convert requires csv or json exports, the manifest has: {', '.join(unconvertible)}")
+    schemas = get_workbook_schemas(client, [target['workbook_id'] for target in targets], args.max_in_flight)
+    history = read_export_history(args.history) if args.history else None
+    targets = expand_targets(targets, schemas)
+    check_output_paths(targets, args.convert)
+    targets = schedule_targets(targets, schemas, history, args.priority)
+    conversions = {
+        workbook_id: get_conversion(args, schema) for workbook_id, schema in schemas.items()
+        if not isinstance(schema, Exception)
+    } if args.convert else None
+    cache = get_cache(args)
+    versions = get_workbook_versions(client, schemas, args.max_in_flight) if cache else None
+    results = export_targets(client, targets, args.max_in_flight, args.poll_interval, args.poll_timeout,
+                             conversions, cache, versions, args.force)
+    write_export_report(results, args.report)
+    return results
+
+
+DESCRIPTION = 'Export a workbook, its elements, or a manifest of workbooks from Sigma'
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--workbook_id', type=str, help='ID of workbook to be exported (required without --manifest)')
     parser.add_argument(
-        '--env', type=str, required=True, help='env to use: [production | staging].')
+        '--element_id', type=str, help='Optional workbook element')
     parser.add_argument(
-        '--cloud', type=str, required=True, help='Cloud to use: [aws | gcp]')
+        '--filename', type=str, help='Optional filename prefix')
     parser.add_argument(
-        '--client_id', type=str, required=True, help='Client ID generated from Sigma')
+        '--format', type=str, default='json', help='Optional format: [csv | json | pdf]')
     parser.add_argument(
-        '--client_secret', type=str, required=True, help='Client secret generated from Sigma')
+        '--manifest', type=str, help='Optional CSV file of workbooks and elements to export in one run. Required column: Workbook ID, Optional columns: Element ID,Format,Filename,Priority')
     parser.add_argument(
-        '--workbook_id', type=str, required=True, help='ID of workbook to be exported')
+        '--priority', type=str, default='small_first', choices=PRIORITIES, help='Optional order to start manifest exports without a Priority in: [small_first | manifest] (default small_first)')
     parser.add_argument(
-        '--element_id', type=str, help='Optional workbook element')
+        '--history', type=str, help='Optional --report file of a previous manifest run, used to estimate element sizes for small_first')
     parser.add_argument(
-        '--filename', type=str, help='Optional filename prefix')
+        '--report', type=str, help='Optional path to write the manifest run\'s per-element result CSV to (default: print it)')
     parser.add_argument(
-        '--format', type=str, default='json', help='Optional format: [csv | json | pdf]')
+        '--use_async', action='store_true', help='Optional: export elements with the asyncio client instead of threads (requires aiohttp)')
+    parser.add_argument(
+        '--max_in_flight', type=int, default=1, help='Optional maximum number of element exports running at once when exporting a whole workbook (default 1)')
+    parser.add_argument(
+        '--poll_interval', type=float, default=10, help='Optional maximum seconds between checks of whether an export is ready (default 10)')
+    parser.add_argument(
+        '--poll_timeout', type=float, default=3600, help='Optional seconds to wait for an export before giving up (default 3600)')
+    parser.add_argument(
+        '--convert', type=str, choices=CONVERT_FORMATS, help='Optional: convert csv or json exports to [parquet | arrow] as they download (requires pyarrow)')
+    parser.add_argument(
+        '--row_group_size', type=int, default=DEFAULT_ROW_GROUP_SIZE, help=f'Optional maximum number of rows converted at a time with --convert (default {DEFAULT_ROW_GROUP_SIZE})')
+    parser.add_argument(
+        '--cache_dir', type=str, help='Optional directory to cache exports in; elements of a workbook version that is already cached are copied from it instead of exported')
+    parser.add_argument(
+        '--cache_max_mb', type=float, default=DEFAULT_MAX_BYTES / 1024 / 1024, help=f'Optional size in MiB the export cache is kept under by evicting the least recently used exports (default {DEFAULT_MAX_BYTES // 1024 // 1024})')
+    parser.add_argument(
+        '--force', action='store_true', help='Optional: export every element even if it is cached, refreshing the cache')
+
+
+def check_arguments(parser, args):
+    if not args.workbook_id and not args.manifest:
+        parser.error('--workbook_id is required without --manifest')
+    if args.manifest and (args.workbook_id or args.element_id or args.use_async):
+        parser.error('--manifest cannot be combined with --workbook_id, --element_id or --use_async')
+    if args.use_async and args.element_id:
+        parser.error('--use_async exports every element of a workbook and cannot be combined with --element_id')
+    if args.convert and args.format not in ('csv', 'json') and not args.manifest:
+        parser.error('--convert requires --format csv or json')
 
-    args = parser.parse_args()
 
-    client = SigmaClient(args.env, args.cloud, args.client_id, args.client_secret)
-    if args.element_id:
-        query_id = export_workbook(client, args.workbook_id, args.format, args.element_id)
-        content = retrieve_results(client, query_id)
+def get_client_options(args):
+    return {'pool_maxsize': max(args.max_in_flight, 1)}
+
+
+def run(args, client):
+    if args.use_async:
+        import asyncio
+
+        asyncio.run(async_export_elements(args, client))
+        return
+
+    if args.manifest:
+        try:
+            results = run_manifest(args, client)
+        except ValueError as e:
+            raise SystemExit(f"{e}")
+        if any(result['Status'] == 'failed' for result in results):
+            raise SystemExit(1)
+    elif args.element_id:
+        # Only a converted export needs the schema, for its column types
+        conversion = get_conversion(args, get_workbook_schema(client, args.workbook_id) if args.convert else None)
+        cache = get_cache(args)
+        version = get_workbook_version(client, args.workbook_id) if cache else None
         filename = args.filename if args.filename else args.workbook_id
-        write_to_file(filename, content, args.format)
+        path = get_output_path(filename, conversion.output_format if conversion else args.format)
+        cache_format = get_cache_format(args.format, conversion)
+        stats = {}
+        if not version or args.force or not copy_cached_export(cache, args.workbook_id, args.element_id, cache_format,
+                                                               version, path, stats):
+            query_id = export_workbook(client, args.workbook_id, args.format, args.element_id)
+            download_results(client, query_id, path, args.poll_interval, args.poll_timeout, stats,
+                             open_download=get_download_opener(args.format, args.element_id, conversion))
+            if version:
+                cache.put(args.workbook_id, args.element_id, cache_format, version, path)
+        print(f"Exported element {args.element_id}: {format_download_stats(stats)}")
     else:
         schema = get_workbook_schema(client, args.workbook_id)
         elements = schema["elements"]
-        print(elements)
-        for element_id, _ in elements.items():
-            query_id = export_workbook(client, args.workbook_id, args.format, element_id)
-            content = retrieve_results(client, query_id)
-            filename = args.filename if args.filename else args.workbook_id
-            write_to_file(filename, content, args.format, element_id)
+        logger.info("Exporting workbook elements",
+                    extra={'fields': {'workbook_id': args.workbook_id, 'elements': list(elements)}})
+        cache = get_cache(args)
+        version = get_workbook_version(client, args.workbook_id) if cache else None
+        export_elements(client, args.workbook_id, list(elements), args.format, args.filename, args.max_in_flight,
+                        args.poll_interval, args.poll_timeout, get_conversion(args, schema), cache, version, args.force)
+
+
+def main():
+    run_command(sys.modules[__name__])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+import time
+
+# Outcomes recorded for a row; rows that succeeded or had nothing to change are not retried on resume
+SUCCEEDED = 'succeeded'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+DONE_STATUSES = (SUCCEEDED, UNCHANGED)
+
+
+class Journal():
+    """ Append-only record of the outcome of each row of a batch job
+
+        Each outcome is written as one JSON line, keyed by the row's position in the input and
+        its email, and flushed immediately so that it survives the process being killed. When a
+        row appears more than once, its latest outcome wins. Rows are identified by both
+        position and email so a journal is not applied to a different input by mistake. A line
+        looks like:
+
+            {"row": 3, "email": "a@example.com", "status": "failed", "time": 1700000000.0, "error": "..."}
+
+        with status one of succeeded, unchanged or failed, and error only on failed rows.
+
+        Safe to write to from several threads.
+    """
+
+    def __init__(self, path, resume=False):
+        """ :path:      Journal file
+            :resume:    Load and append to an existing journal instead of starting a new one;
+                        without it, an existing journal at path is overwritten
+        """
+        self.path = path
+        self.done = set()
+        if resume and os.path.exists(path):
+            self._load()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        # Offset just after the last newline, and whether the text after it is a whole entry
+        complete = 0
+        unterminated = None
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):
+                    complete += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash; its row is simply retried
+                    unterminated = False
+                    continue
+                unterminated = not line.endswith(b'\n')
+                key = (entry['row'], entry['email'])
+                if entry['status'] in DONE_STATUSES:
+                    self.done.add(key)
+                else:
+                    self.done.discard(key)
+        if complete < os.path.getsize(self.path):
+            # Records are appended after the last line, so it must end in a newline
+            with open(self.path, 'rb+') as f:
+                if unterminated:
+                    f.seek(0, os.SEEK_END)
+                    f.write(b'\n')
+                else:
+                    f.truncate(complete)
+
+    def is_done(self, row, email):
+        return (row, email) in self.done
+
+    def record(self, row, email, status, error=None):
+        entry = {'row': row, 'email': email, 'status': status, 'time': time.time()}
+        if error:
+            entry['error'] = error
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
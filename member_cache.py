@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils import get_cache_dir
+
+
+def get_member_cache_path(base_url, client_id):
+    key = hashlib.sha256(f"{client_id}|{base_url}".encode()).hexdigest()
+    return os.path.join(get_cache_dir('members'), f"{key}.sqlite")
+
+
+class MemberCache():
+    """ On-disk index of organization members keyed by email
+
+        Backed by SQLite so lookups do not need the member list in memory. A full refresh
+        streams members into the index page by page; between refreshes, entries are kept
+        current by recording the responses of our own updates, and emails missing from the
+        index can be resolved one at a time through the optional lookup callable.
+
+        Supports the subset of dict operations the batch scripts use (get, [], pop, in, values), and is
+        safe to share between threads. peek reads the index without falling back to the lookup.
+    """
+
+    def __init__(self, path, ttl=3600, lookup=None):
+        """ :path:      SQLite file to keep the index in
+            :ttl:       Seconds after a full refresh before the index is considered stale
+            :lookup:    Optional callable resolving an email missing from the index to the member
+                        record with exactly that email, or None
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lookup = lookup
+        self.hits = 0
+        self.misses = 0
+        self._missing = set()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # The index can always be rebuilt from the API, so trade durability for fast per-update commits
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS members (email TEXT PRIMARY KEY, member_id TEXT, record TEXT, generation INTEGER)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def age(self):
+        """ Seconds since the last full refresh, or None if the index was never filled """
+        with self._lock:
+            refreshed_at = self._get_meta('refreshed_at')
+        return time.time() - float(refreshed_at) if refreshed_at else None
+
+    def is_fresh(self):
+        age = self.age()
+        return age is not None and age < self.ttl
+
+    def refresh(self, members):
+        """ Replaces the index with a full member listing
+
+            :members:       Iterable of member records, consumed lazily
+            :returns:       Number of members indexed
+        """
+        with self._lock:
+            generation = int(self._get_meta('generation') or 0) + 1
+            count = 0
+            with self._db:
+                for member in members:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO members (email, member_id, record, generation) VALUES (?, ?, ?, ?)",
+                        (member['email'], member['memberId'], json.dumps(member), generation))
+                    count += 1
+                self._db.execute("DELETE FROM members WHERE generation < ?", (generation,))
+                self._set_meta('generation', generation)
+                self._set_meta('refreshed_at', time.time())
+            self._missing.clear()
+            return count
+
+    def get(self, email, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT record FROM members WHERE email = ?", (email,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            if self.lookup is None or email is None or email in self._missing:
+                return default
+        member = self.lookup(email)
+        if member is None:
+            with self._lock:
+                self._missing.add(email)
+            return default
+        self[email] = member
+        return member
+
+    def peek(self, email, default=None):
+        """ Member record for an email from the index alone, never looked up through the API """
+        with self._lock:
+            row = self._db.execute("SELECT record FROM members WHERE email = ?", (email,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def __getitem__(self, email):
+        member = self.get(email)
+        if member is None:
+            raise KeyError(email)
+        return member
+
+    def __contains__(self, email):
+        return self.get(email) is not None
+
+    def __setitem__(self, email, member):
+        with self._lock:
+            generation = int(self._get_meta('generation') or 0)
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO members (email, member_id, record, generation) VALUES (?, ?, ?, ?)",
+                    (email, member['memberId'], json.dumps(member), generation))
+            self._missing.discard(email)
+
+    def pop(self, email, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT record FROM members WHERE email = ?", (email,)).fetchone()
+            if row is None:
+                return default
+            with self._db:
+                self._db.execute("DELETE FROM members WHERE email = ?", (email,))
+            return json.loads(row[0])
+
+    def values(self):
+        """ Yields every indexed member record, without looking up missing ones """
+        with self._lock:
+            cursor = self._db.execute("SELECT record FROM members")
+        while True:
+            # Read in pages so the whole index is never held in memory
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[0])
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM members").fetchone()[0]
@@ -0,0 +1,231 @@
+import bisect
+import json
+import re
+import sys
+import threading
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+# Collections whose next path segment is a resource id rather than part of the endpoint
+ID_COLLECTIONS = ('connections', 'datasets', 'files', 'members', 'query', 'teams', 'workbooks', 'workspaces')
+
+# Ids under other collections are recognised when they look like a UUID
+_UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+
+def get_endpoint(path):
+    """ Reduces a request path to its endpoint, so that requests for different resources share metrics
+        :path:          API path, e.g. v2/members/abc123?limit=50
+        :returns:       Endpoint with ids replaced, e.g. v2/members/{id}
+    """
+    segments = path.split('?', 1)[0].strip('/').split('/')
+    for i, segment in enumerate(segments):
+        if (i > 0 and segments[i - 1] in ID_COLLECTIONS) or _UUID.fullmatch(segment):
+            segments[i] = '{id}'
+    return '/'.join(segments)
+
+
+def get_body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+class Metrics():
+    """ Request-level metrics for a client, or several clients sharing one instance
+
+        Records per endpoint (method and path with ids removed) a latency histogram, counts
+        of response status codes, retries and bytes sent and received, plus token refreshes
+        and time spent waiting on the rate limiter or backing off. Snapshots can be dumped as
+        JSON or in the Prometheus text exposition format.
+
+        Hooks added with add_hook() are called with an event name ('request', 'retry' or
+        'token_refresh') and a dict of its fields after each event is recorded. Hooks run on the
+        thread or event loop making the request, so they should be quick.
+
+        Safe to share between threads.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.token_refreshes = 0
+        self.rate_limit_wait_seconds = 0.0
+        self.backoff_seconds = 0.0
+        self._endpoints = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def _emit(self, event, fields):
+        for hook in self._hooks:
+            hook(event, fields)
+
+    def _endpoint(self, method, endpoint):
+        key = (method, endpoint)
+        if key not in self._endpoints:
+            self._endpoints[key] = {
+                'requests': 0, 'errors': 0, 'statuses': {}, 'retries': {}, 'bytes_sent': 0, 'bytes_received': 0,
+                'latency_buckets': [0] * len(self.buckets), 'latency_sum': 0.0, 'latency_max': 0.0,
+            }
+        return self._endpoints[key]
+
+    def observe(self, method, endpoint, status, seconds, bytes_sent=0, bytes_received=0):
+        """ Records one HTTP request
+            :method:            HTTP method
+            :endpoint:          Endpoint, as returned by get_endpoint()
+            :status:            Response status code, or None if no response was received
+            :seconds:           Time until the response headers (or body, if not streamed) arrived
+            :bytes_sent:        Size of the request body
+            :bytes_received:    Size of the response body
+        """
+        with self._lock:
+            stats = self._endpoint(method, endpoint)
+            stats['requests'] += 1
+            if status is None:
+                stats['errors'] += 1
+            else:
+                stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                stats['latency_buckets'][index] += 1
+            stats['latency_sum'] += seconds
+            stats['latency_max'] = max(stats['latency_max'], seconds)
+        self._emit('request', {'method': method, 'endpoint': endpoint, 'status': status, 'seconds': seconds,
+                               'bytes_sent': bytes_sent, 'bytes_received': bytes_received})
+
+    def retry(self, method, endpoint, reason, delay):
+        """ Records a request about to be retried
+            :reason:        Status code that caused the retry, or 'connection_error'
+            :delay:         Seconds the client backs off before retrying
+        """
+        reason = str(reason)
+        with self._lock:
+            retries = self._endpoint(method, endpoint)['retries']
+            retries[reason] = retries.get(reason, 0) + 1
+            self.backoff_seconds += delay
+        self._emit('retry', {'method': method, 'endpoint': endpoint, 'reason': reason, 'delay': delay})
+
+    def token_refreshed(self, expires_in=None):
+        with self._lock:
+            self.token_refreshes += 1
+        self._emit('token_refresh', {'expires_in': expires_in})
+
+    def rate_limited(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self.rate_limit_wait_seconds += seconds
+
+    def snapshot(self):
+        """ Returns the metrics recorded so far
+            :returns:       Dict with totals and, under 'endpoints', a dict per "METHOD endpoint"
+                            with request, status, retry and byte counts and a cumulative latency
+                            histogram keyed by bucket upper bound
+        """
+        with self._lock:
+            endpoints = {}
+            for (method, endpoint), stats in sorted(self._endpoints.items()):
+                histogram = {}
+                cumulative = 0
+                for bound, count in zip(self.buckets, stats['latency_buckets']):
+                    cumulative += count
+                    histogram[str(bound)] = cumulative
+                histogram['+Inf'] = stats['requests']
+                endpoints[f"{method} {endpoint}"] = {
+                    'method': method,
+                    'endpoint': endpoint,
+                    'requests': stats['requests'],
+                    'connection_errors': stats['errors'],
+                    'statuses': {str(status): count for status, count in sorted(stats['statuses'].items())},
+                    'retries': dict(stats['retries']),
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'latency_seconds': {
+                        'sum': stats['latency_sum'],
+                        'max': stats['latency_max'],
+                        'mean': stats['latency_sum'] / stats['requests'] if stats['requests'] else 0.0,
+                        'buckets': histogram,
+                    },
+                }
+            return {
+                'requests': sum(stats['requests'] for stats in endpoints.values()),
+                'token_refreshes': self.token_refreshes,
+                'rate_limit_wait_seconds': self.rate_limit_wait_seconds,
+                'backoff_seconds': self.backoff_seconds,
+                'endpoints': endpoints,
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix='sigma_api'):
+        """ Renders the metrics in the Prometheus text exposition format
+            :prefix:        Prefix of every metric name
+            :returns:       Text ending in a newline
+        """
+        snapshot = self.snapshot()
+        endpoints = snapshot['endpoints'].values()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels)
+                lines.append(f"{prefix}_{name}{suffix}{{{label_text}}} {value}" if labels else f"{prefix}_{name}{suffix} {value}")
+
+        def labels_of(stats, *extra):
+            return (('method', stats['method']), ('endpoint', stats['endpoint'])) + extra
+
+        histogram = []
+        for stats in endpoints:
+            latency = stats['latency_seconds']
+            for bound, count in latency['buckets'].items():
+                histogram.append(('_bucket', labels_of(stats, ('le', bound)), count))
+            histogram.append(('_sum', labels_of(stats), latency['sum']))
+            histogram.append(('_count', labels_of(stats), stats['requests']))
+        metric('request_duration_seconds', 'histogram', 'Latency of API requests.', histogram)
+        metric('responses_total', 'counter', 'API responses by status code.',
+               [('', labels_of(stats, ('status', status)), count)
+                for stats in endpoints for status, count in stats['statuses'].items()])
+        metric('connection_errors_total', 'counter', 'API requests that failed without a response.',
+               [('', labels_of(stats), stats['connection_errors']) for stats in endpoints])
+        metric('retries_total', 'counter', 'API requests retried, by reason.',
+               [('', labels_of(stats, ('reason', reason)), count)
+                for stats in endpoints for reason, count in stats['retries'].items()])
+        metric('request_bytes_total', 'counter', 'Bytes sent in API request bodies.',
+               [('', labels_of(stats), stats['bytes_sent']) for stats in endpoints])
+        metric('response_bytes_total', 'counter', 'Bytes received in API response bodies.',
+               [('', labels_of(stats), stats['bytes_received']) for stats in endpoints])
+        metric('token_refreshes_total', 'counter', 'Access tokens fetched.', [('', (), snapshot['token_refreshes'])])
+        metric('rate_limit_wait_seconds_total', 'counter', 'Time spent waiting on the client-side rate limiter.',
+               [('', (), snapshot['rate_limit_wait_seconds'])])
+        metric('backoff_seconds_total', 'counter', 'Time spent backing off before retries.',
+               [('', (), snapshot['backoff_seconds'])])
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, fmt='json'):
+        """ Writes the metrics to a file
+            :path:          File to write, or '-' for stdout
+            :fmt:           'json' or 'prometheus'
+        """
+        text = self.to_prometheus() if fmt == 'prometheus' else self.to_json() + '\n'
+        if path == '-':
+            sys.stdout.write(text)
+            return
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
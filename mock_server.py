@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from metrics import get_endpoint
+
+MEMBER_TYPES = ('admin', 'creator', 'explorer', 'viewer')
+
+# Columns of every generated workbook element, as (name, type) in the element's schema
+ELEMENT_COLUMNS = (('Order Id', 'number'), ('Customer', 'text'), ('Amount', 'number'), ('Shipped', 'boolean'),
+                   ('Ordered At', 'datetime'))
+
+# Response bodies are written in chunks of this size so large exports are not copied in one go
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class MockState():
+    """ Organization data served by the mock API: members, grants, workbooks and export queries
+
+        Everything is generated from a seed, so two servers started with the same options serve
+        the same data.
+    """
+
+    def __init__(self, members=1000, elements=4, export_rows=10000, export_delay=1.0, workbook_version=1, seed=0):
+        self.export_rows = export_rows
+        self.workbook_version = workbook_version
+        self.export_delay = export_delay
+        self.elements = elements
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.members = {}
+        self.member_list = []
+        self.member_ids_by_email = {}
+        self.grants = {}
+        self.queries = {}
+        rng = random.Random(seed)
+        for i in range(members):
+            self._add_member({
+                'memberId': f"{rng.getrandbits(64):016x}",
+                'email': f"user{i}@example.com",
+                'firstName': f"First{i}",
+                'lastName': f"Last{i}",
+                'memberType': MEMBER_TYPES[i % len(MEMBER_TYPES)],
+                'isArchived': False,
+                'isInactive': False,
+            })
+
+    def _add_member(self, member):
+        self.members[member['memberId']] = member
+        self.member_list.append(member)
+        self.member_ids_by_email[member['email'].lower()] = member['memberId']
+
+    def issue_token(self, ttl):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + ttl
+        return token
+
+    def is_valid_token(self, token):
+        with self.lock:
+            expires_at = self.tokens.get(token)
+        return expires_at is not None and time.time() < expires_at
+
+    def get_workbook(self, workbook_id):
+        return {
+            'workbookId': workbook_id,
+            'name': f"Workbook {workbook_id}",
+            'latestVersion': self.workbook_version,
+            'updatedAt': f"2024-01-01T00:00:{self.workbook_version % 60:02d}Z",
+        }
+
+    def get_schema(self, workbook_id):
+        return {
+            'workbookId': workbook_id,
+            'elements': {
+                f"element{i}": {
+                    'name': f"Element {i}",
+                    'rowCount': self.get_row_count(i),
+                    'columns': [{'name': name, 'type': column_type} for name, column_type in ELEMENT_COLUMNS],
+                }
+                for i in range(self.elements)
+            }
+        }
+
+    def get_row_count(self, element_index):
+        # Elements get progressively larger so that schedulers have something to order
+        return max(self.export_rows * (element_index + 1) // self.elements, 1)
+
+
+def generate_rows(count, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield (i, f"Customer {rng.randrange(1000)}", round(rng.uniform(0, 1000), 2), rng.random() < 0.5,
+               f"2024-01-{rng.randrange(1, 29):02d}T{rng.randrange(24):02d}:00:00Z")
+
+
+def render_export(export_format, rows):
+    """ Export body in the given format
+        :rows:          Iterable of row tuples in ELEMENT_COLUMNS order
+        :returns:       Bytes of the export
+    """
+    names = [name for name, _ in ELEMENT_COLUMNS]
+    if export_format == 'csv':
+        lines = [','.join(names)]
+        lines.extend(','.join(str(value).lower() if isinstance(value, bool) else str(value) for value in row)
+                     for row in rows)
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+    if export_format == 'json':
+        lines = [json.dumps(dict(zip(names, row))) for row in rows]
+        return ('[\n' + ',\n'.join(lines) + '\n]\n').encode('utf-8')
+    return b'%PDF-1.4\n% mock export\n' + b'0' * 1024 + b'\n%%EOF\n'
+
+
+class MockSigmaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and small bodies in one segment, or clients wait out delayed ACKs on every request
+    wbufsize = WRITE_CHUNK_SIZE
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body=None, headers=None):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_json(self):
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def _handle(self, method):
+        options = self.server.options
+        url = urlparse(self.path)
+        segments = [unquote(segment) for segment in url.path.strip('/').split('/')]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.count(method, segments)
+        if options.latency or options.latency_jitter:
+            time.sleep(options.latency + random.uniform(0, options.latency_jitter))
+
+        if segments == ['v2', 'auth', 'token'] and method == 'POST':
+            self._read_body()
+            token = self.server.state.issue_token(options.token_ttl)
+            return self._send_json(200, {'access_token': token, 'token_type': 'bearer',
+                                         'expires_in': options.token_ttl, 'refresh_token': uuid.uuid4().hex})
+
+        # Injected failures are decided before the request is authenticated or applied, like a proxy would
+        roll = random.random()
+        if roll < options.throttle_rate:
+            self._read_body()
+            return self._send_json(429, {'message': 'Too many requests'}, {'Retry-After': str(options.retry_after)})
+        if roll < options.throttle_rate + options.error_rate:
+            self._read_body()
+            return self._send_json(options.error_status, {'message': 'Injected error'})
+
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or not self.server.state.is_valid_token(authorization[7:]):
+            self._read_body()
+            return self._send_json(401, {'message': 'Unauthorized'})
+
+        route = ROUTES.get((method, len(segments), segments[1] if len(segments) > 1 else None))
+        if route is None or segments[0] != 'v2':
+            self._read_body()
+            return self._send_json(404, {'message': 'Not found'})
+        return route(self, segments, query)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def list_members(self, segments, query):
+        state = self.server.state
+        limit = min(int(query.get('limit', 50)), 1000)
+        offset = int(query.get('page') or 0)
+        include_archived = query.get('includeArchived') == 'true'
+        search = query.get('search', '').lower()
+        with state.lock:
+            if include_archived and not search:
+                members = state.member_list
+            else:
+                members = [m for m in state.member_list
+                           if (include_archived or not m['isArchived'])
+                           and (not search or search in m['email'].lower()
+                                or search in f"{m['firstName']} {m['lastName']}".lower())]
+            entries = [dict(m) for m in members[offset:offset + limit]]
+            total = len(members)
+        next_page = str(offset + limit) if offset + limit < total else None
+        self._send_json(200, {'entries': entries, 'nextPage': next_page, 'total': total})
+
+    def create_member(self, segments, query):
+        state = self.server.state
+        body = self._read_json()
+        member_type = str(body.get('memberType', '')).lower()
+        if member_type not in MEMBER_TYPES:
+            return self._send_json(404, {'message': 'Member type name is not found'})
+        with state.lock:
+            if body.get('email', '').lower() in state.member_ids_by_email:
+                return self._send_json(409, {'message': 'Duplicate record'})
+            member = {
+                'memberId': uuid.uuid4().hex[:16],
+                'email': body['email'],
+                'firstName': body.get('firstName', ''),
+                'lastName': body.get('lastName', ''),
+                'memberType': member_type,
+                'isArchived': False,
+                'isInactive': False,
+            }
+            state._add_member(member)
+        self._send_json(200, member)
+
+    def update_member(self, segments, query):
+        state = self.server.state
+        body = self._read_json()
+        member_id = segments[2]
+        with state.lock:
+            member = state.members.get(member_id)
+            if member is None:
+                return self._send_json(404, {'message': 'Member not found'})
+            if 'memberType' in body:
+                if str(body['memberType']).lower() not in MEMBER_TYPES:
+                    return self._send_json(404, {'message': 'Member type name is not found'})
+                body['memberType'] = body['memberType'].lower()
+            if 'email' in body:
+                existing = state.member_ids_by_email.get(body['email'].lower())
+                if existing is not None and existing != member_id:
+                    return self._send_json(409, {'message': 'Duplicate record'})
+                del state.member_ids_by_email[member['email'].lower()]
+                state.member_ids_by_email[body['email'].lower()] = member_id
+            for field in ('email', 'firstName', 'lastName', 'memberType', 'isArchived'):
+                if field in body:
+                    member[field] = body[field]
+            member = dict(member)
+        self._send_json(200, member)
+
+    def add_grants(self, segments, query):
+        state = self.server.state
+        grants = self._read_json().get('grants', [])
+        with state.lock:
+            for grant in grants:
+                member_id = grant.get('grantee', {}).get('memberId')
+                if member_id not in state.members:
+                    return self._send_json(400, {'message': f"Member {member_id} not found"})
+            state.grants.setdefault((segments[1], segments[2]), []).extend(grants)
+        self._send_json(200, {})
+
+    def get_workbook(self, segments, query):
+        self._send_json(200, self.server.state.get_workbook(segments[2]))
+
+    def get_schema(self, segments, query):
+        if segments[3] != 'schema':
+            return self._send_json(404, {'message': 'Not found'})
+        self._send_json(200, self.server.state.get_schema(segments[2]))
+
+    def export_workbook(self, segments, query):
+        state = self.server.state
+        body = self._read_json()
+        if segments[3] != 'export':
+            return self._send_json(404, {'message': 'Not found'})
+        element_id = body.get('elementId') or 'element0'
+        try:
+            element_index = int(element_id[len('element'):])
+        except ValueError:
+            return self._send_json(400, {'message': f"Element {element_id} not found"})
+        query_id = uuid.uuid4().hex
+        with state.lock:
+            state.queries[query_id] = {
+                'ready_at': time.time() + state.export_delay,
+                'format': body.get('format', {}).get('type', 'json'),
+                'rows': state.get_row_count(element_index),
+                'seed': f"{segments[2]}/{element_id}",
+                'content': None,
+            }
+        self._send_json(200, {'queryId': query_id})
+
+    def download_query(self, segments, query):
+        state = self.server.state
+        if segments[3] != 'download':
+            return self._send_json(404, {'message': 'Not found'})
+        with state.lock:
+            export = state.queries.get(segments[2])
+        if export is None:
+            return self._send_json(404, {'message': 'Query not found'})
+        if time.time() < export['ready_at']:
+            return self._send_json(204)
+        with state.lock:
+            if export['content'] is None:
+                export['content'] = render_export(export['format'], generate_rows(export['rows'], export['seed']))
+            content = export['content']
+
+        start = 0
+        status = 200
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes=') and range_header.endswith('-'):
+            start = min(int(range_header[len('bytes='):-1]), len(content))
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{len(content) - 1}/{len(content)}")
+        self.end_headers()
+        view = memoryview(content)
+        for offset in range(start, len(content), WRITE_CHUNK_SIZE):
+            self.wfile.write(view[offset:offset + WRITE_CHUNK_SIZE])
+
+
+# (method, number of path segments, collection) -> handler
+ROUTES = {
+    ('GET', 2, 'members'): MockSigmaHandler.list_members,
+    ('POST', 2, 'members'): MockSigmaHandler.create_member,
+    ('PATCH', 3, 'members'): MockSigmaHandler.update_member,
+    ('POST', 4, 'connections'): MockSigmaHandler.add_grants,
+    ('POST', 4, 'workspaces'): MockSigmaHandler.add_grants,
+    ('GET', 3, 'workbooks'): MockSigmaHandler.get_workbook,
+    ('GET', 4, 'workbooks'): MockSigmaHandler.get_schema,
+    ('POST', 4, 'workbooks'): MockSigmaHandler.export_workbook,
+    ('GET', 4, 'query'): MockSigmaHandler.download_query,
+}
+
+
+class MockSigmaServer(ThreadingHTTPServer):
+    """ Local stand-in for the Sigma REST API
+
+        Implements the endpoints the scripts use, so that they can be run and benchmarked
+        offline against `--env dev` (http://127.0.0.1:8081):
+
+            POST  v2/auth/token
+            GET   v2/members                    paginated with limit/page, search, includeArchived
+            POST  v2/members
+            PATCH v2/members/{id}               404 for unknown member types, 409 for taken emails
+            POST  v2/connections/{id}/grants
+            POST  v2/workspaces/{id}/grants
+            GET   v2/workbooks/{id}             latestVersion is --workbook_version
+            GET   v2/workbooks/{id}/schema
+            POST  v2/workbooks/{id}/export
+            GET   v2/query/{id}/download        204 until export_delay has passed, then 200; honours Range
+
+        Every request can be delayed by latency plus up to latency_jitter seconds, and a
+        throttle_rate/error_rate fraction of requests other than token requests are answered
+        with 429 (with Retry-After) or error_status instead.
+
+        Use as a context manager, or call start() and stop():
+
+            with MockSigmaServer(members=5000, latency=0.02) as server:
+                ...
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8081, members=1000, elements=4, export_rows=10000, export_delay=1.0,
+                 workbook_version=1, latency=0.0, latency_jitter=0.0, throttle_rate=0.0, error_rate=0.0, error_status=503, retry_after=1,
+                 token_ttl=3600, seed=0, verbose=False):
+        self.options = argparse.Namespace(latency=latency, latency_jitter=latency_jitter, throttle_rate=throttle_rate,
+                                          error_rate=error_rate, error_status=error_status, retry_after=retry_after,
+                                          token_ttl=token_ttl, verbose=verbose)
+        self.state = MockState(members, elements, export_rows, export_delay, workbook_version, seed)
+        self.requests = {}
+        self._requests_lock = threading.Lock()
+        self._thread = None
+        super().__init__((host, port), MockSigmaHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, method, segments):
+        key = f"{method} {get_endpoint('/'.join(segments))}"
+        with self._requests_lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a local stand-in for the Sigma API on http://127.0.0.1:8081, the API used by --env dev')
+    parser.add_argument(
+        '--port', type=int, default=8081, help='Optional port to listen on (default 8081)')
+    parser.add_argument(
+        '--members', type=int, default=1000, help='Optional number of organization members to generate (default 1000)')
+    parser.add_argument(
+        '--elements', type=int, default=4, help='Optional number of elements in every workbook (default 4)')
+    parser.add_argument(
+        '--export_rows', type=int, default=10000, help='Optional number of rows in the largest element\'s export (default 10000)')
+    parser.add_argument(
+        '--export_delay', type=float, default=1.0, help='Optional seconds before an export query\'s results are ready (default 1)')
+    parser.add_argument(
+        '--workbook_version', type=int, default=1, help='Optional latestVersion of every workbook, to test export caching (default 1)')
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help='Optional seconds added to every response (default 0)')
+    parser.add_argument(
+        '--latency_jitter', type=float, default=0.0, help='Optional maximum random seconds added on top of --latency (default 0)')
+    parser.add_argument(
+        '--throttle_rate', type=float, default=0.0, help='Optional fraction of requests answered with 429 (default 0)')
+    parser.add_argument(
+        '--retry_after', type=int, default=1, help='Optional Retry-After seconds sent with 429 responses (default 1)')
+    parser.add_argument(
+        '--error_rate', type=float, default=0.0, help='Optional fraction of requests answered with --error_status (default 0)')
+    parser.add_argument(
+        '--error_status', type=int, default=503, help='Optional status code of injected errors (default 503)')
+    parser.add_argument(
+        '--token_ttl', type=int, default=3600, help='Optional seconds access tokens stay valid (default 3600)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='Optional seed for the generated data and injected failures (default 0)')
+    parser.add_argument(
+        '--verbose', action='store_true', help='Optional: log every request')
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+    server = MockSigmaServer(port=args.port, members=args.members, elements=args.elements,
+                             export_rows=args.export_rows, export_delay=args.export_delay,
+                             workbook_version=args.workbook_version, latency=args.latency,
+                             latency_jitter=args.latency_jitter, throttle_rate=args.throttle_rate,
+                             error_rate=args.error_rate, error_status=args.error_status, retry_after=args.retry_after,
+                             token_ttl=args.token_ttl, seed=args.seed, verbose=args.verbose)
+    print(f"Serving mock Sigma API on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.requests, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
-import argparse
+import csv
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import SigmaClient
+import requests
+
+from utils import run_command
 
 
 def create_member(client, email, first_name, last_name, member_type):
@@ -28,33 +34,68 @@ def create_member(client, email, first_name, last_name, member_type):
         "v2/members",
         json=payload
     )
+    response.raise_for_status()
     data = response.json()
     return data["memberId"]
 
 
-def grant_connection(client, connection_id, permission, member_id):
-    """ Grants connection permission to a member
+def get_grants_payload(grants):
+    """ Builds the body of a grants request
 
-        :access_token:   Generated access token
-        :connection_id:  ID of connection
-        :permission:     Permission to be granted
-        :member_id:      ID of the member to be granted permission
+        :grants:        List of (member ID, permission) tuples
 
     """
-    payload = {
+    return {
         "grants": [
             {
                 "grantee": {"memberId": member_id},
                 "permission": permission
             }
+            for member_id, permission in grants
         ]
     }
-    client.post(
+
+
+def grant_connection_members(client, connection_id, grants):
+    """ Grants connection permissions to several members in one request
+
+        :connection_id:  ID of connection
+        :grants:         List of (member ID, permission) tuples
+
+        :returns:        API response
+
+    """
+    return client.post(
         f"v2/connections/{connection_id}/grants",
-        json=payload
+        json=get_grants_payload(grants)
     )
 
 
+def grant_workspace_members(client, workspace_id, grants):
+    """ Grants workspace permissions to several members in one request
+
+        :workspace_id:  ID of workspace
+        :grants:        List of (member ID, permission) tuples
+
+        :returns:       API response
+
+    """
+    return client.post(
+        f"v2/workspaces/{workspace_id}/grants", json=get_grants_payload(grants))
+
+
+def grant_connection(client, connection_id, permission, member_id):
+    """ Grants connection permission to a member
+
+        :access_token:   Generated access token
+        :connection_id:  ID of connection
+        :permission:     Permission to be granted
+        :member_id:      ID of the member to be granted permission
+
+    """
+    grant_connection_members(client, connection_id, [(member_id, permission)])
+
+
 def grant_workspace(client, workspace_id, permission, member_id):
     """ Grants workspace permission to a member
 
@@ -64,44 +105,281 @@ def grant_workspace(client, workspace_id, permission, member_id):
         :member_id:     ID of the member to be granted permission
 
     """
-    payload = {
-        "grants": [
-            {
-                "grantee": {"memberId": member_id},
-                "permission": permission
-            }
-        ]
-    }
-    client.post(
-        f"v2/workspaces/{workspace_id}/grants", json=payload)
+    grant_workspace_members(client, workspace_id, [(member_id, permission)])
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Onboard a new organization member')
+# Errors caused by some of the grants in a batch, which splitting the batch can isolate
+SPLIT_STATUS_CODES = (400, 409, 422)
+
+
+class GrantBatcher():
+    """ Queues grants per connection or workspace and sends them in batches
+
+        A target's queue is flushed as soon as it holds batch_size grants, or once its oldest
+        grant has waited flush_interval seconds. When the API rejects the contents of a batch
+        (400, 409 or 422), the batch is split in half and each half retried, until the grants it
+        rejects are isolated; the rest of the batch still goes through. Any other error, such as
+        throttling or a missing permission, fails the whole batch, since splitting it would only
+        repeat the error.
+
+        Every grant's outcome is passed to on_result(context, kind, target_id, error), with error
+        None on success. Safe to use from several threads; close() flushes whatever is left.
+    """
+
+    def __init__(self, client, batch_size=100, flush_interval=5.0, on_result=None):
+        self.client = client
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.on_result = on_result
+        self.requests_sent = 0
+        self.grants_sent = 0
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_expired, daemon=True)
+        self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, kind, target_id, member_id, permission, context=None):
+        """ Queues a grant
+
+            :kind:          'connection' or 'workspace'
+            :target_id:     ID of the connection or workspace
+            :context:       Passed back to on_result with the grant's outcome
+        """
+        key = (kind, target_id)
+        with self._lock:
+            queued_at, entries = self._queues.setdefault(key, (time.monotonic(), []))
+            entries.append((member_id, permission, context))
+            if len(entries) < self.batch_size:
+                return
+            del self._queues[key]
+        self._send(kind, target_id, entries)
+
+    def flush(self):
+        with self._lock:
+            queues, self._queues = self._queues, {}
+        for (kind, target_id), (_, entries) in queues.items():
+            self._send(kind, target_id, entries)
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_expired(self):
+        while not self._closed.wait(min(self.flush_interval, 1.0)):
+            now = time.monotonic()
+            with self._lock:
+                expired = [key for key, (queued_at, _) in self._queues.items()
+                           if now - queued_at >= self.flush_interval]
+                batches = [(key, self._queues.pop(key)[1]) for key in expired]
+            for (kind, target_id), entries in batches:
+                self._send(kind, target_id, entries)
+
+    def _send(self, kind, target_id, entries):
+        grant = grant_connection_members if kind == 'connection' else grant_workspace_members
+        error = None
+        try:
+            response = grant(self.client, target_id, [(member_id, permission) for member_id, permission, _ in entries])
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as errh:
+            error = f"{errh.response.status_code} {errh.response.text}"
+            if errh.response.status_code in SPLIT_STATUS_CODES and len(entries) > 1:
+                with self._lock:
+                    self.requests_sent += 1
+                middle = len(entries) // 2
+                self._send(kind, target_id, entries[:middle])
+                self._send(kind, target_id, entries[middle:])
+                return
+        except Exception as e:
+            error = f"{e}"
+        with self._lock:
+            self.requests_sent += 1
+            if error is None:
+                self.grants_sent += len(entries)
+        if self.on_result:
+            for _, _, context in entries:
+                self.on_result(context, kind, target_id, error)
+
+
+connection_permission_map = {
+    'creator': 'annotate', 'explorer': 'usage'}
+workspace_permission_map = {
+    'admin': 'edit', 'creator': 'organize', 'explorer': 'explore', 'viewer': 'view'}
+
+
+def get_grant_target(member_type, connection_id=None, workspace_id=None):
+    """ Works out which grant a new member should receive
+
+        A connection grant takes precedence over a workspace grant.
+
+        :returns:       Tuple of (target kind, target ID, permission), or None if no grant was asked for
+
+    """
+    if connection_id:
+        return 'connection', connection_id, connection_permission_map[member_type]
+    elif workspace_id:
+        return 'workspace', workspace_id, workspace_permission_map[member_type]
+    return None
+
+
+# Columns of the bulk onboarding CSV
+BULK_REQUIRED_COLUMNS = ('Email', 'First Name', 'Last Name', 'Member Type')
+BULK_REPORT_COLUMNS = ('Email', 'Member ID', 'Created', 'Grant', 'Error')
+
+
+def read_bulk_members(path):
+    """ Reads the members to onboard from a CSV file
+
+        Required columns: Email, First Name, Last Name, Member Type.
+        Optional columns: Connection ID, Workspace ID (override --connection_id/--workspace_id per row).
+
+        :returns:       List of rows as dicts
+
+    """
+    with open(path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        missing = [c for c in BULK_REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"The CSV is missing required columns: {', '.join(missing)}")
+        return list(reader)
+
+
+def onboard_row(client, row, connection_id=None, workspace_id=None, batcher=None):
+    """ Creates the member for one CSV row and queues its grant
+
+        :batcher:       GrantBatcher to queue the member's grant on
+
+        :returns:       Dict with the row's result; its Grant field is filled in once the grant is sent
+
+    """
+    result = {'Email': row['Email'], 'Member ID': '', 'Created': 'no', 'Grant': '', 'Error': ''}
+    try:
+        member_id = create_member(client, row['Email'], row['First Name'], row['Last Name'], row['Member Type'])
+    except requests.exceptions.HTTPError as errh:
+        result['Error'] = f"Create failed: {errh.response.status_code} {errh.response.text}"
+        return result
+    except Exception as e:
+        result['Error'] = f"Create failed: {e}"
+        return result
+    result['Member ID'] = member_id
+    result['Created'] = 'yes'
+    row_connection_id = (row.get('Connection ID') or '').strip()
+    row_workspace_id = (row.get('Workspace ID') or '').strip()
+    if not (row_connection_id or row_workspace_id):
+        # The row's own columns override both command-line IDs, not just the matching one
+        row_connection_id, row_workspace_id = connection_id, workspace_id
+    try:
+        target = get_grant_target(row['Member Type'], row_connection_id, row_workspace_id)
+    except KeyError:
+        result['Grant'] = 'failed'
+        result['Error'] = f"No grant permission is defined for member type {row['Member Type']}"
+        return result
+    if target is None:
+        result['Grant'] = 'none'
+    else:
+        kind, target_id, permission = target
+        result['Grant'] = 'pending'
+        batcher.add(kind, target_id, member_id, permission, context=result)
+    return result
+
+
+def record_grant(result, kind, target_id, error):
+    """ Records the outcome of a queued grant on its row result """
+    if error is None:
+        result['Grant'] = f"{kind} {target_id}"
+    else:
+        result['Grant'] = 'failed'
+        result['Error'] = f"Grant on {kind} {target_id} failed: {error}"
+
+
+def onboard_members(client, rows, connection_id=None, workspace_id=None, workers=1, grant_batch_size=100,
+                    grant_flush_interval=5.0):
+    """ Onboards many members: creates them concurrently and sends their grants in batches
+
+        :rows:                  Rows read by read_bulk_members
+        :workers:               Number of members to create concurrently
+        :grant_batch_size:      Maximum number of grants per request
+        :grant_flush_interval:  Maximum seconds a grant waits for its batch to fill up
+
+        :returns:               List of per-row results in CSV order
+
+    """
+    with GrantBatcher(client, grant_batch_size, grant_flush_interval, on_result=record_grant) as batcher:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = list(executor.map(
+                lambda row: onboard_row(client, row, connection_id, workspace_id, batcher), rows))
+    print(f"Sent {batcher.grants_sent} grants in {batcher.requests_sent} requests", file=sys.stderr)
+    return results
+
+
+def write_report(results, path=None):
+    """ Writes the per-row results as CSV to path, or to stdout """
+    out = open(path, 'w', newline='') if path else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=BULK_REPORT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+    finally:
+        if path:
+            out.close()
+
+
+DESCRIPTION = 'Onboard a new organization member, or many members from a CSV file'
+
+
+def add_arguments(parser):
     parser.add_argument(
-        '--env', type=str, required=True, help='env to use: [production | staging].')
+        '--email', type=str, help='Email of new member to be created (required without --csv)')
     parser.add_argument(
-        '--cloud', type=str, required=True, help='Cloud to use: [aws | gcp]')
+        '--first_name', type=str, help='First name of new member to be created (required without --csv)')
     parser.add_argument(
-        '--client_id', type=str, required=True, help='Client ID generated from Sigma')
+        '--last_name', type=str, help='Last name of new member to be created (required without --csv)')
     parser.add_argument(
-        '--client_secret', type=str, required=True, help='Client secret generated from Sigma')
+        '--member_type', type=str, help='Member type of new member to be created (required without --csv)')
     parser.add_argument(
-        '--email', type=str, required=True, help='Email of new member to be created')
+        '--csv', type=str, help='Optional CSV file of members to onboard in bulk. Required columns: Email,First Name,Last Name,Member Type, Optional columns: Connection ID,Workspace ID')
     parser.add_argument(
-        '--first_name', type=str, required=True, help='First name of new member to be created')
+        '--workers', type=int, default=1, help='Optional number of members to create concurrently in bulk mode (default 1)')
     parser.add_argument(
-        '--last_name', type=str, required=True, help='Last name of new member to be created')
+        '--report', type=str, help='Optional path to write the bulk mode per-row result CSV to (default: print it)')
     parser.add_argument(
-        '--member_type', type=str, required=True, help='Email of new member to be created')
+        '--grant_batch_size', type=int, default=100, help='Optional maximum number of grants sent per request in bulk mode (default 100)')
+    parser.add_argument(
+        '--grant_flush_interval', type=float, default=5.0, help='Optional maximum seconds a grant waits for its batch to fill up in bulk mode (default 5)')
     parser.add_argument(
         '--connection_id', type=str, help='Optional ID of connection to grant permission')
     parser.add_argument(
         '--workspace_id', type=str, help='Optional ID of workspace to grant permission')
 
-    args = parser.parse_args()
-    client = SigmaClient(args.env, args.cloud, args.client_id, args.client_secret)
+
+def check_arguments(parser, args):
+    if not args.csv and not (args.email and args.first_name and args.last_name and args.member_type):
+        parser.error('--email, --first_name, --last_name and --member_type are required without --csv')
+
+
+def get_client_options(args):
+    return {'pool_maxsize': max(args.workers, 1)}
+
+
+def run(args, client):
+    if args.csv:
+        try:
+            rows = read_bulk_members(args.csv)
+        except ValueError as e:
+            raise SystemExit(f"{e}")
+        results = onboard_members(client, rows, args.connection_id, args.workspace_id, args.workers,
+                                  args.grant_batch_size, args.grant_flush_interval)
+        write_report(results, args.report)
+        failed = sum(1 for result in results if result['Error'])
+        print(f"Onboarded {len(results) - failed} of {len(results)} members", file=sys.stderr)
+        return
 
     # Create new organization member
     member_id = create_member(client, args.email,
@@ -109,18 +387,18 @@ def main():
 
     # Assign the member to a connection
     if args.connection_id:
-        connection_permission_map = {
-            'creator': 'annotate', 'explorer': 'usage'}
         permission = connection_permission_map[args.member_type]
         grant_connection(client, args.connection_id,
                          permission, member_id)
     # Assign the member to a workspace
     elif args.workspace_id:
-        workspace_permission_map = {
-            'admin': 'edit', 'creator': 'organize', 'explorer': 'explore', 'viewer': 'view'}
         permission = workspace_permission_map[args.member_type]
         grant_workspace(client, args.workspace_id, permission, member_id)
 
 
+def main():
+    run_command(sys.modules[__name__])
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import logging
+import shlex
+import sys
+import time
+
+# Command -> (module implementing it, summary). A command's module, and with it requests and
+# the rest of the client, is only imported once the command is known to run.
+COMMANDS = {
+    'update-members': ('batch_update_users', 'Batch update members from a CSV file'),
+    'onboard': ('onboard_member', 'Onboard a new member, or many members from a CSV file'),
+    'export': ('export_workbook', 'Export a workbook, its elements, or a manifest of workbooks'),
+}
+
+
+def load_command(name):
+    """ Imports the module implementing a command
+        :returns:       Module, see utils.run_command for what it provides
+    """
+    return importlib.import_module(COMMANDS[name][0])
+
+
+def get_usage():
+    lines = ['commands:']
+    for name, (_, summary) in COMMANDS.items():
+        lines.append(f"  {name:<16}{summary}")
+    lines.append(f"  {'serve':<16}Run commands read one per line from stdin with one client and access token")
+    lines.append('')
+    lines.append("Run 'sigma_cli.py <command> --help' for a command's arguments.")
+    return '\n'.join(lines)
+
+
+def run_job(client, line, client_args):
+    """ Runs one command line of serve mode on the shared client
+
+        :line:          Command and its arguments, without the credentials, logging and metrics
+                        arguments, which are taken from serve's own
+        :client_args:   Dict of serve's arguments for the credentials, logging and metrics
+
+        :returns:       Exit code of the command
+
+    """
+    argv = shlex.split(line)
+    if argv[0] not in COMMANDS:
+        print(f"Unknown command {argv[0]!r}, expected one of: {', '.join(COMMANDS)}", file=sys.stderr)
+        return 2
+    command = load_command(argv[0])
+    parser = argparse.ArgumentParser(prog=f"sigma_cli.py serve: {argv[0]}", description=command.DESCRIPTION)
+    command.add_arguments(parser)
+    parser.set_defaults(**client_args)
+    rate_limiter = client.rate_limiter
+    try:
+        args = parser.parse_args(argv[1:])
+        command.check_arguments(parser, args)
+        # The pool size is fixed when the client is created, but a command's rate limit applies to its job
+        client.rate_limiter = command.get_client_options(args).get('rate_limiter') or rate_limiter
+        command.run(args, client)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        client.rate_limiter = rate_limiter
+    return 0
+
+
+def serve(argv):
+    """ Runs many commands in one process, sharing a warm client and access token between them
+
+        Each line of stdin (or --jobs) is a command line such as
+        `export --workbook_id abc --format csv`. Blank lines and lines starting with # are
+        skipped. A failing command is logged and does not stop the ones after it.
+
+    """
+    from metrics import Metrics
+    from utils import add_client_arguments, configure_logging, create_client
+
+    parser = argparse.ArgumentParser(
+        prog='sigma_cli.py serve', description='Run commands read one per line from stdin with one client and access token')
+    add_client_arguments(parser)
+    parser.add_argument(
+        '--jobs', type=str, help='Optional file of command lines to run instead of stdin')
+    parser.add_argument(
+        '--pool_size', type=int, default=16, help='Optional maximum number of connections kept open to the API (default 16)')
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+    logger = logging.getLogger('sigma.cli')
+    client_args = {key: getattr(args, key) for key in ('env', 'cloud', 'client_id', 'client_secret', 'token_cache',
+                                                       'log_level', 'metrics', 'metrics_format')}
+    # Jobs do not write metrics of their own; serve writes the total when it ends
+    client_args['metrics'] = None
+    metrics = Metrics()
+    jobs = open(args.jobs) if args.jobs else sys.stdin
+    failed = 0
+    count = 0
+    try:
+        with create_client(args, metrics, pool_maxsize=max(args.pool_size, 1)) as client:
+            client.tokens.token()
+            for line in jobs:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                count += 1
+                started = time.perf_counter()
+                try:
+                    code = run_job(client, line, client_args)
+                except Exception:
+                    logger.error("Job raised an exception", exc_info=True, extra={'fields': {'job': count}})
+                    code = 1
+                fields = {'job': count, 'command': line.split(None, 1)[0], 'exit_code': code,
+                          'seconds': round(time.perf_counter() - started, 3)}
+                if code:
+                    failed += 1
+                    logger.warning("Job failed", extra={'fields': fields})
+                else:
+                    logger.info("Job finished", extra={'fields': fields})
+                sys.stdout.flush()
+    finally:
+        if args.jobs:
+            jobs.close()
+        if args.metrics:
+            metrics.dump(args.metrics, args.metrics_format)
+    logger.info("Served jobs", extra={'fields': {'jobs': count, 'failed': failed}})
+    if failed:
+        raise SystemExit(1)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        prog='sigma_cli.py', usage='%(prog)s <command> [arguments]',
+        description='Run the Sigma API scripts as commands of one program',
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=get_usage())
+    parser.add_argument('command', choices=list(COMMANDS) + ['serve'], help='Command to run')
+    # Only the command is parsed here; its arguments are parsed by the command's own parser
+    args = parser.parse_args(argv[:1])
+    if args.command == 'serve':
+        serve(argv[1:])
+        return
+    from utils import run_command
+
+    run_command(load_command(args.command), argv[1:], prog=f"sigma_cli.py {args.command}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+
+from columnar import ColumnarDownload, CsvRowParser, JsonRowParser, pyarrow
+
+CSV_TEXT = 'id,name,note\r\n1,Ada,"said ""hi"",\r\nthen left"\r\n2,Bob,plain\r\n3,"Cy, Jr.",\n'
+CSV_ROWS = [
+    ['id', 'name', 'note'],
+    ['1', 'Ada', 'said "hi",\r\nthen left'],
+    ['2', 'Bob', 'plain'],
+    ['3', 'Cy, Jr.', ''],
+]
+
+JSON_TEXT = '[{"id": 1, "note": "a \\"quoted\\" }, {tricky]"},\n{"id": 2, "note": "line\\nbreak"},{"id": 3, "note": null}]'
+JSON_ROWS = [
+    {'id': 1, 'note': 'a "quoted" }, {tricky]'},
+    {'id': 2, 'note': 'line\nbreak'},
+    {'id': 3, 'note': None},
+]
+
+
+def parse(parser, text, size):
+    """ Feeds text to parser in chunks of size characters, then closes it """
+    rows = []
+    for start in range(0, len(text), size):
+        rows.extend(parser.feed(text[start:start + size]))
+    rows.extend(parser.close() or [])
+    return rows
+
+
+class CsvRowParserTest(unittest.TestCase):
+
+    def test_every_chunk_size(self):
+        # Chunk sizes from 1 up split rows at every position, including inside quoted fields
+        for size in range(1, len(CSV_TEXT) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(parse(CsvRowParser(), CSV_TEXT, size), CSV_ROWS)
+
+    def test_split_inside_quotes(self):
+        parser = CsvRowParser()
+        self.assertEqual(parser.feed('id,note\n1,"first\n'), [['id', 'note']])
+        self.assertEqual(parser.feed('second"\n2,'), [['1', 'first\nsecond']])
+        self.assertEqual(parser.close(), [['2', '']])
+
+    def test_last_row_without_newline(self):
+        self.assertEqual(parse(CsvRowParser(), 'a,b\n1,2', 3), [['a', 'b'], ['1', '2']])
+
+
+class JsonRowParserTest(unittest.TestCase):
+
+    def test_every_chunk_size(self):
+        for size in range(1, len(JSON_TEXT) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(parse(JsonRowParser(), JSON_TEXT, size), JSON_ROWS)
+
+    def test_json_lines(self):
+        text = '\n'.join('{"id": %d, "note": "x\\"y"}' % i for i in range(3)) + '\n'
+        for size in range(1, len(text) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(parse(JsonRowParser(), text, size),
+                                 [{'id': i, 'note': 'x"y'} for i in range(3)])
+
+    def test_split_inside_quotes(self):
+        parser = JsonRowParser()
+        self.assertEqual(parser.feed('[{"id": 1, "note": "open {'), [])
+        self.assertEqual(parser.feed('"}, {"id": 2'), [{'id': 1, 'note': 'open {'}])
+        self.assertEqual(parser.feed('}]'), [{'id': 2}])
+        parser.close()
+
+    def test_truncated_export(self):
+        parser = JsonRowParser()
+        parser.feed('[{"id": 1}, {"id": ')
+        with self.assertRaises(ValueError):
+            parser.close()
+
+
+@unittest.skipIf(pyarrow is None, "requires pyarrow")
+class ColumnarDownloadTest(unittest.TestCase):
+
+    def convert(self, source_format, text, columns=None):
+        with tempfile.TemporaryDirectory() as directory:
+            download = ColumnarDownload(os.path.join(directory, 'export.parquet'), source_format, columns=columns)
+            try:
+                data = text.encode('utf-8')
+                for start in range(0, len(data), 7):
+                    download.write(data[start:start + 7])
+                path = download.commit()
+            except Exception:
+                download.discard()
+                raise
+            return pyarrow.parquet.read_table(path)
+
+    def test_json_columns_come_from_the_export(self):
+        # The schema names columns differently and in another order; it only supplies types
+        columns = {'Order Id': 'number', 'Customer': 'text', 'Unused': 'number'}
+        table = self.convert('json', '[{"customer": "a", "order_id": 1}, {"order_id": 2}]', columns)
+        self.assertEqual(table.column_names, ['customer', 'order_id'])
+        self.assertEqual(table.to_pydict(), {'customer': ['a', None], 'order_id': [1.0, 2.0]})
+
+    def test_json_rejects_added_keys(self):
+        with self.assertRaisesRegex(ValueError, 'extra'):
+            self.convert('json', '{"id": 1}\n{"id": 2, "extra": 3}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,59 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS_FORMATS, Metrics, get_body_size, get_endpoint
+
+logger = logging.getLogger('sigma.client')
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+class JsonLogFormatter(logging.Formatter):
+    """ Formats log records as one JSON object per line
+
+        Structured values passed with extra={'fields': {...}} are added to the object.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='info', stream=None):
+    """ Sends the scripts' logs to stderr as JSON lines
+        :level:         Lowest level to log: debug, info, warning or error
+        :stream:        Optional stream to log to instead of stderr
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonLogFormatter())
+    root = logging.getLogger('sigma')
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    root.propagate = False
 
 
 def get_base_url(cloud: str, env: str):
-    print(env)
-    print(cloud)
     base_url = ''
     if env == 'dev':
         base_url = 'http://127.0.0.1:8081'
@@ -24,22 +72,40 @@ def get_base_url(cloud: str, env: str):
             base_url = 'https://api.staging.us.azure.sigmacomputing.io'
         elif env == 'prod' or env == 'production':
             base_url = 'https://api.us.azure.sigmacomputing.com'
+    logger.info("Using Sigma API", extra={'fields': {'env': env, 'cloud': cloud, 'base_url': base_url}})
     return base_url
 
 
-def get_access_token(base_url, client_id, client_secret):
-    """ Gets the access token from Sigma
+def fetch_access_token(base_url, client_id, client_secret, session=None, metrics=None):
+    """ Requests a new access token from Sigma
         :client_id:     Client ID generated from Sigma
         :client_secret: Client secret generated from Sigma
-        :returns:       Access token
+        :session:       Optional requests session to send the request on
+        :metrics:       Optional Metrics to record the request in
+        :returns:       Token response, including access_token and expires_in
     """
     payload = {
         "grant_type": "client_credentials",
         "client_id": client_id,
         "client_secret": client_secret
     }
-    response = requests.post(f"{base_url}/v2/auth/token", data=payload)
-    data = response.json()
+    http = session if session is not None else requests
+    started = time.perf_counter()
+    response = http.post(f"{base_url}/v2/auth/token", data=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if metrics is not None:
+        metrics.observe('POST', 'v2/auth/token', response.status_code, time.perf_counter() - started,
+                        get_body_size(response.request.body), len(response.content))
+    return response.json()
+
+
+def get_access_token(base_url, client_id, client_secret, session=None):
+    """ Gets the access token from Sigma
+        :client_id:     Client ID generated from Sigma
+        :client_secret: Client secret generated from Sigma
+        :session:       Optional requests session to send the request on
+        :returns:       Access token
+    """
+    data = fetch_access_token(base_url, client_id, client_secret, session)
     return data["access_token"]
 
 
@@ -51,44 +117,585 @@ def get_headers(access_token):
     return {"Authorization": "Bearer " + access_token}
 
 
+def get_cache_dir(name):
+    """ Directory for the scripts' cached state of the given kind, e.g. tokens """
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'sigma-sample-api', name)
+
+
+def get_token_cache_dir():
+    return get_cache_dir('tokens')
+
+
+class TokenManager():
+    """ Keeps a valid access token for one client ID and API host
+
+        The expiry is taken from the token response's expires_in. token() refreshes when the
+        current token is within refresh_margin seconds of expiring, or half its lifetime for
+        tokens issued for less than twice refresh_margin, and with background=True a
+        daemon timer refreshes it ahead of time so requests never wait on /v2/auth/token.
+        Refreshes happen under a lock, so concurrent callers trigger a single token request.
+
+        With cache=True the token is persisted to a file only the current user can read, keyed
+        by client ID and base URL, so that back-to-back script runs can reuse it.
+    """
+
+    def __init__(self, base_url, client_id, client_secret, session=None, refresh_margin=60,
+                 background=True, cache=False, cache_dir=None, metrics=None):
+        self.base_url = base_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self.metrics = metrics
+        self.cache_path = None
+        if cache:
+            key = hashlib.sha256(f"{client_id}|{base_url}".encode()).hexdigest()
+            self.cache_path = os.path.join(cache_dir or get_token_cache_dir(), f"{key}.json")
+        self.refreshes = 0
+        self._token = None
+        self._expires_at = None
+        self._lifetime = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._load_cache()
+
+    def token(self):
+        """ Returns an access token that is not about to expire, refreshing it if needed
+            :returns:       Access token
+        """
+        with self._lock:
+            if self._needs_refresh():
+                self._refresh()
+            return self._token
+
+    def current(self):
+        """ Returns the access token without refreshing it
+            :returns:       Access token, or None if there is none or it is about to expire
+        """
+        with self._lock:
+            return None if self._needs_refresh() else self._token
+
+    def invalidate(self, stale):
+        """ Replaces a token the API rejected, unless another caller already replaced it
+            :stale:         Access token that received a 401
+            :returns:       Access token to retry with
+        """
+        with self._lock:
+            if self._token == stale or self._token is None:
+                self._refresh()
+            return self._token
+
+    def store(self, data):
+        """ Records a token response fetched elsewhere, such as by AsyncSigmaClient
+            :data:          Token response JSON
+            :returns:       Access token
+        """
+        with self._lock:
+            self._set_token(data)
+            return self._token
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _needs_refresh(self):
+        if self._token is None:
+            return True
+        return self._expires_at is not None and time.time() >= self._expires_at - self._margin()
+
+    def _margin(self):
+        """ Seconds before expiry to refresh at; capped so short-lived tokens are still used for a while """
+        if self._lifetime:
+            return min(self.refresh_margin, self._lifetime / 2)
+        return self.refresh_margin
+
+    def _refresh(self):
+        data = fetch_access_token(self.base_url, self.client_id, self.client_secret, self.session, self.metrics)
+        self._set_token(data)
+
+    def _set_token(self, data):
+        self._token = data["access_token"]
+        expires_in = data.get("expires_in")
+        self._expires_at = time.time() + float(expires_in) if expires_in else None
+        self._lifetime = float(expires_in) if expires_in else None
+        self.refreshes += 1
+        if self.metrics is not None:
+            self.metrics.token_refreshed(expires_in)
+        logger.info("Fetched access token", extra={'fields': {'expires_in': expires_in}})
+        self._save_cache()
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.background or self._expires_at is None:
+            return
+        delay = max(self._expires_at - self._margin() - time.time(), 1)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            if self._timer is None or not self._needs_refresh():
+                return
+            self._timer = None
+            try:
+                self._refresh()
+            except (requests.exceptions.RequestException, KeyError, ValueError, OSError) as e:
+                # The next call to token() retries the refresh in the foreground
+                logger.warning("Background token refresh failed", extra={'fields': {'error': str(e)}})
+
+    def _load_cache(self):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._lifetime = cached.get("expires_in")
+        if cached.get("expires_at") and time.time() < cached["expires_at"] - self._margin():
+            self._token = cached["access_token"]
+            self._expires_at = cached["expires_at"]
+            self._schedule()
+        else:
+            self._lifetime = None
+
+    def _save_cache(self):
+        if self.cache_path is None:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"access_token": self._token, "expires_at": self._expires_at, "expires_in": self._lifetime}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            # The cache only saves a token request on the next run; carry on without it
+            logger.warning("Could not write the token cache, continuing without it",
+                           extra={'fields': {'path': self.cache_path, 'error': str(e)}})
+            self.cache_path = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter that keeps count of how often pooled connections are reused
+
+        urllib3 tracks, per host pool, how many connections it had to open and how many
+        requests it sent. Pools that get evicted from the pool manager are folded into
+        running totals before they are closed so the counters never go backwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._stats_lock = threading.Lock()
+        self._retired_connections = 0
+        self._retired_requests = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        dispose = self.poolmanager.pools.dispose_func
+
+        def retire(pool):
+            with self._stats_lock:
+                self._retired_connections += pool.num_connections
+                self._retired_requests += pool.num_requests
+            dispose(pool)
+
+        self.poolmanager.pools.dispose_func = retire
+
+    def connection_stats(self):
+        """ Returns connection reuse counters for every pool this adapter has used
+            :returns:       Dict with connections opened, requests sent and connections reused
+        """
+        with self._stats_lock:
+            opened = self._retired_connections
+            sent = self._retired_requests
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {
+            "connections_opened": opened,
+            "requests_sent": sent,
+            "connections_reused": max(sent - opened, 0)
+        }
+
+
+def create_session(pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True):
+    """ Creates a pooled requests session
+        :pool_connections:  Number of per-host connection pools to cache
+        :pool_maxsize:      Maximum number of connections kept open per host
+        :pool_block:        Block when a host's pool is exhausted instead of opening extra connections
+        :keep_alive:        Reuse connections between requests
+        :returns:           requests.Session with a PooledHTTPAdapter mounted for http and https
+    """
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+# Seconds to wait for a connection to the API, and for the next data on it. A request has no
+# overall time limit, which would cut off large export downloads that are still making progress.
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300
+
+# Status codes worth retrying: the API is throttling us or a proxy in front of it is unavailable
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# Status codes that mean the API wants clients to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+# Status codes worth retrying for a POST, which may have been applied when the gateway answered
+# 502 or 504; 429 and 503 mean the request was turned away
+POST_RETRY_STATUS_CODES = (429, 503)
+
+
+def get_retry_status_codes(method, retry_status_codes=None):
+    """ Status codes a request is retried on
+        :retry_status_codes:    Optional codes to retry on for this request instead of the default
+    """
+    if retry_status_codes is not None:
+        return retry_status_codes
+    return POST_RETRY_STATUS_CODES if method == 'POST' else RETRY_STATUS_CODES
+
+
+class RateLimiter():
+    """ Token bucket with AIMD (additive increase, multiplicative decrease) rate adaptation
+
+        One limiter can be shared by every thread and coroutine talking to the API. Callers
+        reserve a token under a lock and are told how long to wait for it, so threads sleep
+        with acquire() and coroutines await acquire_async() against the same bucket.
+
+        The configured rate is the ceiling. A throttled response multiplies the current rate by
+        `decrease`, at most once per congestion event: throttles arriving within `cooldown`
+        seconds (or one request interval at the current rate, if longer) of the last decrease
+        are answers to requests sent before it and are ignored. Every successful response adds
+        `increase` requests/s spread over one second's worth of requests, ramping back up
+        towards the ceiling.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.5, increase=1.0, decrease=0.5, cooldown=1.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.burst = float(burst) if burst else max(self.max_rate, 1.0)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._decreased_at = None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.throttled_time = 0.0
+        self.throttle_events = 0
+
+    def _reserve(self):
+        """ Takes a token from the bucket
+            :returns:       Seconds the caller must wait before using its token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.throttled_time += wait
+            return wait
+
+    def acquire(self):
+        """ Blocks the calling thread until a request may be sent
+            :returns:       Seconds spent waiting
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """ Suspends the calling coroutine until a request may be sent
+            :returns:       Seconds spent waiting
+        """
+        import asyncio
+
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._decreased_at is not None and now - self._decreased_at < max(self.cooldown, 1 / self.rate):
+                return
+            self._decreased_at = now
+            self.throttle_events += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+
+def get_retry_after(response, limit=300):
+    """ Reads the Retry-After header of a response
+        :response:      Response from the API
+        :limit:         Upper bound in seconds for the returned delay
+        :returns:       Seconds to wait, or None if the header is absent or unparseable
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0.0), limit)
+
+
+def get_backoff(attempt, base=0.5, limit=30):
+    """ Exponential backoff with jitter
+        :attempt:       Zero-based retry attempt
+        :returns:       Seconds to wait before the next attempt
+    """
+    return random.uniform(0.5, 1.0) * min(limit, base * 2 ** (attempt + 1))
+
+
 class SigmaClient():
-    def __init__(self, env, cloud, client_id, client_secret):
+    """ Pooled, rate limited client for the Sigma REST API
+
+        Requests are retried on throttling and gateway errors, and recorded in self.metrics:
+        pass a shared Metrics instance to aggregate several clients, or add hooks to it to
+        observe each request as it completes. Each request is also logged at debug level to
+        the 'sigma.client' logger, and each retry at info level.
+
+        Requests are sent with timeout, a (connect, read) tuple in seconds, unless a call passes its
+        own. A read timeout retries idempotent requests; a download stalled by one is resumed.
+    """
+
+    def __init__(self, env, cloud, client_id, client_secret, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keep_alive=True, rate_limiter=None, token_cache=False, token_manager=None,
+                 metrics=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
         self.client_id = client_id
         self.client_secret = client_secret
         self.base_url = get_base_url(cloud, env)
-        self.headers = self._get_headers()
+        self.session = create_session(pool_connections, pool_maxsize, pool_block, keep_alive)
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._stats_lock = threading.Lock()
+        self._throttle_stats = {"useful_seconds": 0.0, "backoff_seconds": 0.0, "retries": 0, "throttled_responses": 0}
+        if token_manager is None:
+            token_manager = TokenManager(self.base_url, client_id, client_secret, self.session, cache=token_cache,
+                                         metrics=self.metrics)
+        self.tokens = token_manager
+
+    @property
+    def headers(self):
+        return get_headers(self.tokens.token())
 
-    def _get_headers(self):
-        return get_headers(get_access_token(self.base_url, self.client_id, self.client_secret))
+    def connection_stats(self):
+        """ Returns connection reuse counters summed over the session's adapters
+            :returns:       Dict with connections opened, requests sent and connections reused
+        """
+        totals = {"connections_opened": 0, "requests_sent": 0, "connections_reused": 0}
+        for adapter in set(self.session.adapters.values()):
+            if isinstance(adapter, PooledHTTPAdapter):
+                for key, value in adapter.connection_stats().items():
+                    totals[key] += value
+        return totals
+
+    def throttle_stats(self):
+        """ Returns how much time requests spent throttled compared to talking to the API
+            :returns:       Dict of seconds spent waiting on the rate limiter, backing off before
+                            retries and inside HTTP calls, plus retry and throttled response counts
+        """
+        with self._stats_lock:
+            stats = dict(self._throttle_stats)
+        stats["limiter_seconds"] = self.rate_limiter.throttled_time if self.rate_limiter else 0.0
+        stats["throttled_seconds"] = stats["limiter_seconds"] + stats["backoff_seconds"]
+        if self.rate_limiter:
+            stats["current_rate"] = self.rate_limiter.rate
+        return stats
+
+    def _add_stat(self, key, value):
+        with self._stats_lock:
+            self._throttle_stats[key] += value
+
+    def close(self):
+        self.tokens.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def post(self, path, **kwargs):
-        return self._exec(requests.post, path, **kwargs)
+        return self._exec(self.session.post, path, **kwargs)
 
     def get(self, path, **kwargs):
-        return self._exec(requests.get, path, **kwargs)
+        return self._exec(self.session.get, path, **kwargs)
 
     def put(self, path, **kwargs):
-        return self._exec(requests.put, path, **kwargs)
+        return self._exec(self.session.put, path, **kwargs)
 
     def delete(self, path, **kwargs):
-        return self._exec(requests.delete, path, **kwargs)
+        return self._exec(self.session.delete, path, **kwargs)
 
     def patch(self, path, **kwargs):
-        return self._exec(requests.patch, path, **kwargs)
+        return self._exec(self.session.patch, path, **kwargs)
 
-    def _exec(self, func, path, retries=5, exc=None, **kwargs):
-        if retries < 0:
-            raise exc
-        try:
-            url = f'{self.base_url}/{path}'
-            headers: dict = kwargs.pop('headers', {})
-            headers.update(self.headers)
-            response = func(url, headers=headers, **kwargs)
-            if response.status_code == 401:
-                self.headers = self._get_headers()
-                headers.update(self.headers)
+    def _exec(self, func, path, retries=5, retry_status_codes=None, **kwargs):
+        url = f'{self.base_url}/{path}'
+        method = func.__name__.upper()
+        endpoint = get_endpoint(path)
+        retry_status_codes = get_retry_status_codes(method, retry_status_codes)
+        kwargs.setdefault('timeout', self.timeout)
+        headers: dict = kwargs.pop('headers', {})
+        refreshed = False
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.metrics.rate_limited(self.rate_limiter.acquire())
+            token = self.tokens.token()
+            headers.update(get_headers(token))
+            started = time.perf_counter()
+            try:
                 response = func(url, headers=headers, **kwargs)
-            return response
-        except requests.exceptions.ConnectionError as e:
-            time.sleep(1)
-            return self._exec(func, path, retries - 1, exc=e, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+                elapsed = time.perf_counter() - started
+                self._add_stat("useful_seconds", elapsed)
+                self.metrics.observe(method, endpoint, None, elapsed)
+                # A POST that timed out waiting for its response may have been carried out
+                timed_out = isinstance(e, requests.exceptions.ReadTimeout)
+                if attempt >= retries or (timed_out and method == 'POST'):
+                    logger.warning("Request failed", extra={'fields': {
+                        'method': method, 'endpoint': endpoint, 'attempt': attempt, 'error': str(e)}})
+                    raise
+                reason = 'timeout' if timed_out else 'connection_error'
+                delay = get_backoff(attempt)
+            else:
+                elapsed = time.perf_counter() - started
+                self._add_stat("useful_seconds", elapsed)
+                self._observe(method, endpoint, response, elapsed, kwargs.get('stream', False))
+                if response.status_code == 401 and not refreshed:
+                    refreshed = True
+                    response.close()
+                    self.tokens.invalidate(token)
+                    continue
+                if response.status_code in THROTTLE_STATUS_CODES:
+                    self._add_stat("throttled_responses", 1)
+                    if self.rate_limiter:
+                        self.rate_limiter.on_throttle()
+                elif self.rate_limiter:
+                    self.rate_limiter.on_success()
+                if response.status_code not in retry_status_codes or attempt >= retries:
+                    return response
+                delay = get_retry_after(response)
+                if delay is None:
+                    delay = get_backoff(attempt)
+                reason = response.status_code
+                response.close()
+            self.metrics.retry(method, endpoint, reason, delay)
+            logger.info("Retrying request", extra={'fields': {
+                'method': method, 'endpoint': endpoint, 'attempt': attempt + 1, 'reason': reason, 'delay': delay}})
+            attempt += 1
+            self._add_stat("retries", 1)
+            self._add_stat("backoff_seconds", delay)
+            time.sleep(delay)
+
+    def _observe(self, method, endpoint, response, elapsed, stream):
+        bytes_sent = get_body_size(response.request.body) if response.request is not None else 0
+        if stream:
+            # The body has not been read yet; count what the server says it is sending
+            bytes_received = int(response.headers.get('Content-Length') or 0)
+        else:
+            bytes_received = len(response.content)
+        self.metrics.observe(method, endpoint, response.status_code, elapsed, bytes_sent, bytes_received)
+        logger.debug("Request completed", extra={'fields': {
+            'method': method, 'endpoint': endpoint, 'status': response.status_code,
+            'seconds': round(elapsed, 4), 'bytes_sent': bytes_sent, 'bytes_received': bytes_received}})
+
+
+def add_client_arguments(parser):
+    """ Adds the arguments every script takes: API credentials, logging and metrics """
+    parser.add_argument(
+        '--env', type=str, required=True, help='env to use: [production | staging].')
+    parser.add_argument(
+        '--cloud', type=str, required=True, help='Cloud to use: [aws | gcp | azure]')
+    parser.add_argument(
+        '--client_id', type=str, required=True, help='Client ID generated from within Sigma')
+    parser.add_argument(
+        '--client_secret', type=str, required=True, help='Client secret API token generated from within Sigma')
+    parser.add_argument(
+        '--token_cache', action='store_true', help='Optional: reuse the access token across runs by caching it in a file only the current user can read')
+    parser.add_argument(
+        '--log_level', type=str, default='info', choices=LOG_LEVELS, help='Optional level of the JSON logs written to stderr (default info)')
+    parser.add_argument(
+        '--metrics', type=str, help='Optional file to write API request metrics to when the script ends, or - for stdout')
+    parser.add_argument(
+        '--metrics_format', type=str, default='json', choices=METRICS_FORMATS, help='Optional format of --metrics: [json | prometheus] (default json)')
+
+
+def create_client(args, metrics=None, **options):
+    """ Creates the client for the credentials given on the command line
+        :args:          Parsed arguments, see add_client_arguments
+        :options:       Other SigmaClient options, such as pool_maxsize and rate_limiter
+        :returns:       SigmaClient
+    """
+    return SigmaClient(args.env, args.cloud, args.client_id, args.client_secret, token_cache=args.token_cache,
+                       metrics=metrics, **options)
+
+
+def run_command(command, argv=None, prog=None):
+    """ Parses a script's command line and runs it with a new client
+
+        :command:       Module of the script, providing DESCRIPTION, add_arguments(parser),
+                        check_arguments(parser, args), get_client_options(args) and run(args, client)
+        :argv:          Arguments, defaults to sys.argv[1:]
+        :prog:          Program name shown in the usage message
+
+    """
+    parser = argparse.ArgumentParser(prog=prog, description=command.DESCRIPTION)
+    add_client_arguments(parser)
+    command.add_arguments(parser)
+    args = parser.parse_args(argv)
+    command.check_arguments(parser, args)
+    configure_logging(args.log_level)
+    metrics = Metrics()
+    try:
+        with create_client(args, metrics, **command.get_client_options(args)) as client:
+            command.run(args, client)
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics, args.metrics_format)
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers
+        :values:        Numbers to take the percentile of
+        :pct:           Percentile between 0 and 100
+        :returns:       The percentile value, or None when values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]